@@ -0,0 +1,61 @@
+'''Defines the Augmenter class, which makes randomly altered copies of
+training batches so the models see more variety than was recorded. Every
+alteration is done on the whole batch at once with numpy.'''
+
+import numpy as np
+
+SWAP = np.array([1, 0, 2]) # Left and Right trade places when an image is flipped
+
+
+class Augmenter:
+    '''Randomly flips, shifts, and changes the brightness and contrast of the
+    images in a batch. A flipped image has its Left and Right labels swapped.
+    The random choices for a batch depend only on the seed, the epoch and the
+    batch's index, so a training run is reproducible no matter which of
+    keras' worker threads prepares each batch.'''
+
+    def __init__(self, seed = 0, flip = 0.5, shift = 2, brightness = 0.1, contrast = 0.1):
+        '''Takes the seed, the chance of an image being flipped, the most
+        pixels an image is shifted by in each direction, and how far the
+        brightness and contrast may be moved, as a fraction of their range'''
+
+        self.seed = seed
+        self.flip = flip
+        self.shift = shift
+        self.brightness = brightness
+        self.contrast = contrast
+
+    def __call__(self, images, labels, epoch, index):
+        '''Returns augmented copies of a batch of prepared (N, H, W, C) float32
+        images and their integer labels'''
+
+        random = np.random.RandomState([self.seed, epoch, index])
+
+        n, h, w, _ = images.shape
+
+        dy = random.randint(-self.shift, self.shift + 1, n)
+        dx = random.randint(-self.shift, self.shift + 1, n)
+        flipped = random.rand(n) < self.flip
+
+        # Shifting and flipping are both a change in which pixel each output pixel
+        # comes from, so they are done together with a single gather. Pixels shifted
+        # in from outside the image repeat the edge
+        rows = np.clip(np.arange(h)[np.newaxis] - dy[:, np.newaxis], 0, h - 1)
+        cols = np.clip(np.arange(w)[np.newaxis] - dx[:, np.newaxis], 0, w - 1)
+        cols = np.where(flipped[:, np.newaxis], cols[:, ::-1], cols)
+
+        images = images[np.arange(n)[:, np.newaxis, np.newaxis], rows[:, :, np.newaxis], cols[:, np.newaxis, :]]
+        labels = np.where(flipped, SWAP[labels], labels)
+
+        contrast = random.uniform(1 - self.contrast, 1 + self.contrast, (n, 1, 1, 1)).astype(np.float32)
+        brightness = random.uniform(-self.brightness, self.brightness, (n, 1, 1, 1)).astype(np.float32)
+
+        mean = images.mean(axis = (1, 2, 3), keepdims = True)
+
+        images -= mean
+        images *= contrast
+        images += mean + brightness
+
+        np.clip(images, 0, 1, out = images)
+
+        return images, labels
@@ -4,27 +4,112 @@ about the direction the car should drive.'''
 
 import numpy as np
 
-from time import sleep
-from threading import Thread
-from datetime import datetime
+from time import time, perf_counter
+from threading import Thread, Condition
 
-from process import prep_images, reduce_dim
+from process import prep_images, reduce_dim, RESAMPLE, RESOLUTION
+from metrics import Metrics
+from history import FrameHistory
+
+DEADLINE = 0.05 # Seconds allowed between a frame's capture and the car steering
+THRESHOLD = 0.01 # Mean change in pixel brightness (0 to 1) below which a decision is reused
+MAX_REUSE = 0.25 # Longest time, in seconds, that one decision is reused for
+HISTORY_INTERVAL = 0.05 # Seconds between the frames of a temporal model's stack, the recorder's interval
+
+
+class ChangeGate:
+    '''Skips the model when the car's view has barely changed. Each prepared
+    frame is compared with the last frame the model ran on, and if the mean
+    absolute difference of their pixels is below the threshold, the decision
+    made for that frame is reused. A decision is never reused for longer
+    than max_reuse seconds, so the model still runs regularly'''
+
+    def __init__(self, threshold = THRESHOLD, max_reuse = MAX_REUSE):
+        self.threshold = threshold
+        self.max_reuse = max_reuse
+
+        self.reference = None # The last frame the model ran on
+        self.decision = None
+        self.time = 0
+
+        self.skipped = 0 # Frames whose decision was reused
+        self.executed = 0 # Frames the model ran on
+
+    def check(self, images, now):
+        '''Returns the cached decision if it can be reused for these prepared
+        images, or None if the model needs to run'''
+
+        if self.reference is None or self.reference.shape != images.shape or now - self.time > self.max_reuse:
+            return None
+
+        if np.mean(np.abs(images - self.reference)) >= self.threshold:
+            return None
+
+        self.skipped += 1
+
+        return self.decision
+
+    def update(self, images, decision, now):
+        '''Remembers the images the model just ran on, and its decision'''
+
+        if self.reference is None or self.reference.shape != images.shape:
+            self.reference = np.empty_like(images)
+
+        self.reference[...] = images
+        self.decision = decision
+        self.time = now
+
+        self.executed += 1
+
+    def reset(self):
+        '''Forgets the last frame, so the model runs on the next one'''
+
+        self.reference = None
 
 
 class AutoDriver:
     '''Uses a model to decide which direction to steer the car'''
 
-    def __init__(self, car, camera, model, interval):
+    def __init__(self, car, camera, model, deadline = DEADLINE, metrics = None, gate = None, resample = RESAMPLE,
+                 history_interval = HISTORY_INTERVAL, start = True):
         '''Defines the drivers properties, including the car it
         can control, the camera it has access to, the model it
-        relies on to make the decision, and the time between
-        decisions being made. Also begins the main background thread.'''
+        relies on to make the decision, the time allowed from
+        a frame being captured to the car steering, the metrics
+        it records the time spent in each stage to, and an optional
+        ChangeGate that skips the model on unchanged frames. The
+        resampling method has to match the one the model's dataset
+        was shrunk with. Models with more than one input channel are
+        given a stack of the last frames, one every history_interval
+        seconds like the recorder saves them. Also begins the main
+        background thread, unless start is False, for replaying frames
+        without a car or a camera.'''
 
         self.car = car
         self.camera = camera
-        self.model = model
-        self.interval = interval
+        self.deadline = deadline
+        self.gate = gate
+        self.resample = resample
+        self.history_interval = history_interval
         self.auto = False
+        self.started = start # Whether the driver's thread makes the swaps
+        self.condition = Condition() # Wakes the driver when auto mode is turned on, or a model is set
+
+        self.decisions = 0 # Decisions made
+        self.misses = 0 # Decisions that took longer than the deadline
+        self.stale = 0 # Frames skipped because they were already past the deadline
+        self.dropped = 0 # Frames captured while deciding, which were never looked at
+
+        self.pending = None # A (model, resample, swapped) tuple waiting to be swapped in
+        self.configure(model)
+
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        for name in self.stats():
+            self.metrics.counter('autodriver_' + name, lambda name = name: self.stats()[name])
+
+        if not start:
+            return
 
         thread = Thread(target = self.run)
         thread.daemon = True
@@ -34,29 +119,228 @@ class AutoDriver:
         print('Auto Driver Active')
 
     def run(self):
-        '''The primary background thread, that always is running. If auto mode
-        is activated, then an image from the camera will be fed into the model,
-        and the car will be steered in the appropriate direction'''
+        '''The primary background thread, that always is running. It sleeps
+        while auto mode is off. Once it is on, it waits for each new frame from
+        the camera, feeds it into the model, and steers the car in the
+        appropriate direction. Frames that arrive while a decision is being made
+        are skipped, so every decision is made on the newest frame. Models are
+        only swapped here, between two decisions, even while auto mode is off.
+        An error in a decision is logged and turns auto mode off'''
 
-        target_names = ['Left', 'Right', 'Straight']
+        seq = -1 # Sequence number of the last frame a decision was made on
 
         while True:
-            if self.auto:
-                image = prep_images(reduce_dim([self.camera.array()], 4))
+            with self.condition:
+                idle = not self.auto
+                self.condition.wait_for(lambda: self.auto or self.pending is not None)
+
+                old, swapped = self.swap()
+
+            self.retire(old, swapped)
+
+            if idle:
+                seq = -1 # Frames captured while auto mode was off do not count as dropped
+
+            if not self.auto:
+                continue
+
+            try:
+                seq = self.iterate(seq)
+            except Exception as e:
+                print('Auto Driver failed, turning auto mode off: ' + repr(e))
+
+                with self.condition:
+                    self.auto = False
+
+    def iterate(self, seq):
+        '''Makes a decision on the first frame newer than seq, and steers by
+        it. Returns the sequence number of the frame it looked at'''
+
+        frame = self.camera.wait_frame(seq, timeout = 1)
+
+        if frame is None:
+            return seq
+
+        if seq >= 0:
+            self.dropped += frame.seq - seq - 1
+
+        seq = frame.seq
+
+        age = time() - frame.timestamp
+
+        if age > self.deadline:
+            self.stale += 1
+            return seq
+
+        start = perf_counter()
+        images = self.prepare(frame.luma, frame.timestamp)
+        prepared = perf_counter()
+        decision = self.gate.check(images, time()) if self.gate is not None else None
+
+        if decision is None:
+            decision = np.argmax(self.model.predict(images)[0])
+
+            if self.gate is not None:
+                self.gate.update(images, decision, time())
+
+            self.metrics.observe('inference', perf_counter() - prepared)
 
-                decision = np.argmax(self.model.predict(image)[0])
+        predicted = perf_counter()
+        self.steer(decision)
+        steered = perf_counter()
 
-                if decision == 0:
-                    self.car.left()
-                elif decision == 1:
-                    self.car.right()
-                else:
-                    self.car.straight()
+        self.decisions += 1
 
-            sleep(self.interval)
+        latency = age + steered - start
+
+        if latency > self.deadline:
+            self.misses += 1
+
+        self.metrics.observe('wait', age)
+        self.metrics.observe('preprocess', prepared - start)
+        self.metrics.observe('decision', predicted - prepared)
+        self.metrics.observe('actuation', steered - predicted)
+        self.metrics.observe('total', latency)
+
+        return seq
+
+    def configure(self, model):
+        '''Sets up the scale and frame history of a model's input shape. Models
+        without an input shape are given single frames at a quarter of the size.
+        The model is None while the first model is still loading'''
+
+        shape = getattr(model, 'input_shape', None)
+
+        self.model = model
+        self.scale = RESOLUTION // shape[-2] if shape else 4
+        self.frames = shape[-1] if shape else 1
+        self.history = FrameHistory(self.frames, shape[:-1]) if self.frames > 1 else None
+        self.pushed = 0 # Capture time of the newest frame in the history
+
+    def set_model(self, model, resample = None, swapped = None):
+        '''Swaps in a new model, and the resampling method its dataset was
+        shrunk with. While auto mode is on, the swap is made by the driver's
+        thread between two frames, so a decision never mixes the two models.
+        The swap is always made by the driver's thread, and the swapped
+        function is called once the new model is driving. The old model, and
+        any model set before it that never got to drive, are closed on
+        another thread'''
+
+        with self.condition:
+            replaced = self.pending
+            self.pending = (model, resample or self.resample, swapped)
+
+            if self.started:
+                old, swapped = None, None
+                self.condition.notify_all()
+            else:
+                old, swapped = self.swap()
+
+        if replaced is not None:
+            self.retire(replaced[0])
+
+        self.retire(old, swapped)
+
+    def swap(self):
+        '''Swaps in the pending model, and returns the old one and the function
+        to call now that the new one is driving. Called with the condition held'''
+
+        if self.pending is None:
+            return None, None
+
+        old = self.model
+        model, self.resample, swapped = self.pending
+        self.pending = None
+
+        self.configure(model)
+
+        # The gate's last decision was made by the old model
+        if self.gate is not None:
+            self.gate.reset()
+
+        print('Auto Driver swapped models')
+
+        return old, swapped
+
+    def retire(self, model, swapped = None):
+        '''Tells whoever set the new model that it is driving, and releases the
+        old model's resources without holding up the driver'''
+
+        if swapped is not None:
+            swapped()
+
+        if model is not None and hasattr(model, 'close'):
+            thread = Thread(target = model.close)
+            thread.daemon = True
+
+            thread.start()
+
+    def prepare(self, luma, timestamp = None):
+        '''Converts a camera frame into the input the model expects, shrinking
+        it with the same code the dataset was shrunk with. For a temporal model
+        the frame joins the history, or replaces the newest frame in it if it
+        came too soon after that one, and the input is a view of the history'''
+
+        images = prep_images(reduce_dim(luma[np.newaxis], self.scale, self.resample))
+
+        if self.history is None:
+            return images
+
+        if timestamp is None or timestamp - self.pushed >= self.history_interval:
+            self.history.push(images[0, ..., 0])
+            self.pushed = timestamp or 0
+        else:
+            self.history.replace(images[0, ..., 0])
+
+        return self.history.view()[np.newaxis]
+
+    def decide(self, luma):
+        '''Returns the direction the model chooses for a camera frame:
+        0 for left, 1 for right, and 2 for straight'''
+
+        return np.argmax(self.model.predict(self.prepare(luma))[0])
+
+    def steer(self, decision):
+        '''Steers the car in the direction of a decision'''
+
+        if decision == 0:
+            self.car.left()
+        elif decision == 1:
+            self.car.right()
+        else:
+            self.car.straight()
 
     def toggle_auto(self):
-        '''Toggles auto mode on and off.'''
+        '''Toggles auto mode on and off. Auto mode cannot be turned on until
+        the driver has a model.'''
+
+        with self.condition:
+            if self.model is None and not self.auto:
+                print('Auto mode is unavailable until the model has loaded')
+                return
+
+            self.auto = not self.auto
+
+            # Frames from before auto mode was turned off are too old to stack
+            if self.auto and self.history is not None:
+                self.history.reset()
+
+            self.condition.notify_all()
 
-        self.auto = not self.auto
         print('Auto status is ' + str(self.auto))
+
+    def stats(self):
+        '''Returns the counts of decisions made, deadlines missed,
+        and frames skipped since the driver started, and with a gate,
+        how many decisions reused the last one or ran the model'''
+
+        stats = {'decisions': self.decisions,
+                 'misses': self.misses,
+                 'stale': self.stale,
+                 'dropped': self.dropped}
+
+        if self.gate is not None:
+            stats['skipped'] = self.gate.skipped
+            stats['executed'] = self.gate.executed
+
+        return stats
@@ -0,0 +1,90 @@
+'''Defines the BatchSequence class, which streams training batches out of a
+memory-mapped dataset so that datasets larger than memory can be trained on.'''
+
+import numpy as np
+
+from keras.utils import Sequence
+
+from process import prep_images
+
+CLASSES = 3 # Left, Right, and Straight
+
+
+class BatchSequence(Sequence):
+    '''A keras Sequence over a subset of a dataset's rows. Each batch is read
+    from the memory-mapped arrays, normalized to float32, and one-hot encoded
+    only when keras asks for it, so keras' worker threads can prefetch batches
+    while the model trains. Rows are shuffled by index every epoch, and
+    each batch is passed through the augmenter, if there is one. With
+    weights, each batch also has the weight of each of its rows.'''
+
+    def __init__(self, images, labels, indices, batch_size, shuffle = True, seed = None, augment = None, weights = None):
+        self.images = images
+        self.labels = labels
+        self.indices = np.asarray(indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.random = np.random.RandomState(seed)
+        self.augment = augment
+        self.weights = weights
+
+        self.epoch = -1 # Counted up by on_epoch_end, which is also called below
+
+        self.onehot = np.eye(CLASSES, dtype = np.float32)
+        self.order = self.indices.copy()
+
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / self.batch_size))
+
+    def __getitem__(self, index):
+        rows = self.order[index * self.batch_size:(index + 1) * self.batch_size]
+
+        return self.batch(np.sort(rows), index) # Reading rows in order keeps the reads from the memory map sequential
+
+    def batch(self, rows, index):
+        '''Returns the prepared batch of a sorted array of rows'''
+
+        images = prep_images(self.images[rows])
+        labels = self.labels[rows]
+
+        if self.augment is not None:
+            images, labels = self.augment(images, labels, self.epoch, index)
+
+        if self.weights is not None:
+            return images, self.onehot[labels], self.weights[rows]
+
+        return images, self.onehot[labels]
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+        if self.shuffle:
+            self.random.shuffle(self.order)
+
+class BalancedSequence(BatchSequence):
+    '''A BatchSequence whose batches are drawn from a BalancedSampler, so
+    every class is equally likely in every batch. An epoch has as many
+    batches as the rows would fill. Like the augmenter, the rows of a batch
+    depend only on the seed, the epoch and the batch's index'''
+
+    def __init__(self, images, labels, sampler, batch_size, seed = 0, augment = None):
+        self.sampler = sampler
+        self.seed = seed
+
+        BatchSequence.__init__(self, images, labels, sampler.rows, batch_size, shuffle = False, augment = augment)
+
+    def __getitem__(self, index):
+        random = np.random.RandomState([self.seed, self.epoch, index])
+        rows = self.sampler.sample(min(self.batch_size, len(self.indices) - index * self.batch_size), random)
+
+        return self.batch(np.sort(rows), index)
+
+def split(count, val_split):
+    '''Splits the rows of a dataset into training and validation indices. Like
+    keras' validation_split, the last fraction of the rows is used for validation'''
+
+    boundary = int(count * (1 - val_split))
+
+    return np.arange(boundary), np.arange(boundary, count)
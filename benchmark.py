@@ -0,0 +1,320 @@
+'''Benchmarks the car's hot path, from a captured frame to the motors, and the
+throughput of building a dataset and of training, without any car hardware.
+Frames are synthetic, or read from recorded sessions, and the motors are
+stubbed. The results are written as JSON, and can be compared with a stored
+baseline to catch a regression before it shows up as the car wobbling.
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --compare baseline.json'''
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import platform
+import numpy as np
+
+from time import perf_counter, time
+
+import session
+
+from process import RESOLUTION, SCALES, list_sessions, reduce_dim, prep_images
+from registry import read_metadata
+from controller import RESAMPLE
+
+MODELPATH = 'models/modelA6'
+BACKEND = 'numpy'
+SCALE = 4 # Scale the car shrinks frames by
+
+OUTPUT = 'benchmark.json'
+BATCH_SIZES = [1, 2, 4, 8, 16, 32]
+REPEATS = 50 # Times each stage is run, after one untimed run
+FRAMES = 256 # Frames the hot path is benchmarked on
+SESSIONS = 4 # Synthetic sessions the dataset is built from
+SESSION_LENGTH = 1024 # Frames in each synthetic session
+TRAIN_EPOCHS = 2
+TOLERANCE = 0.2 # How much slower than the baseline a stage may be before it is a regression
+SEED = 0
+
+
+def synthetic_frames(count, resolution = RESOLUTION, seed = SEED):
+    '''Returns (count, resolution, resolution) uint8 frames of smooth random
+    shapes with some noise, which compress and shrink like camera frames'''
+
+    random = np.random.RandomState(seed)
+
+    coarse = random.randint(0, 256, (count, resolution // 8, resolution // 8)).astype(np.float32)
+    frames = coarse.repeat(8, axis = 1).repeat(8, axis = 2)
+    frames += random.normal(0, 8, frames.shape)
+
+    return np.clip(frames, 0, 255).astype(np.uint8)
+
+def recorded_frames(directory, count):
+    '''Returns up to count frames from the recorded sessions in a directory'''
+
+    frames = []
+    total = 0
+
+    for name in list_sessions(directory):
+        images, _, _ = session.load(os.path.join(directory, name))
+        frames.append(images[:count - total])
+        total += len(frames[-1])
+
+        if total >= count:
+            break
+
+    return np.concatenate(frames)
+
+def synthetic_model(input_shape = (16, 16, 1), seed = SEED):
+    '''Returns an Engine with model A's layers and random weights, for when
+    there is no exported model to benchmark. It takes as long to run as the
+    trained model does'''
+
+    from engine import Engine, parse
+
+    random = np.random.RandomState(seed)
+
+    def conv(name, filters, first = False):
+        config = {'name': name, 'filters': filters, 'kernel_size': [3, 3], 'strides': [1, 1],
+                  'padding': 'same', 'activation': 'linear'}
+
+        if first:
+            config['batch_input_shape'] = [None] + list(input_shape)
+
+        return {'class_name': 'Conv2D', 'config': config}
+
+    layers = [conv('conv1', 8, True),
+              {'class_name': 'LeakyReLU', 'config': {'name': 'leaky1', 'alpha': 0.1}},
+              {'class_name': 'MaxPooling2D', 'config': {'name': 'pool1', 'pool_size': [2, 2], 'strides': [2, 2], 'padding': 'same'}},
+              conv('conv2', 16),
+              {'class_name': 'LeakyReLU', 'config': {'name': 'leaky2', 'alpha': 0.1}},
+              {'class_name': 'MaxPooling2D', 'config': {'name': 'pool2', 'pool_size': [2, 2], 'strides': [2, 2], 'padding': 'same'}},
+              {'class_name': 'Flatten', 'config': {'name': 'flatten'}},
+              {'class_name': 'Dense', 'config': {'name': 'dense1', 'activation': 'linear'}},
+              {'class_name': 'LeakyReLU', 'config': {'name': 'leaky3', 'alpha': 0.1}},
+              {'class_name': 'Dense', 'config': {'name': 'dense2', 'activation': 'softmax'}}]
+
+    h, w, c = input_shape
+    flat = (h // 4) * (w // 4) * 16
+
+    shapes = {'conv1': (3, 3, c, 8), 'conv2': (3, 3, 8, 16), 'dense1': (flat, 16), 'dense2': (16, 3)}
+    weights = {name: [random.normal(0, 0.1, shape).astype(np.float32), np.zeros(shape[-1], dtype = np.float32)]
+               for name, shape in shapes.items()}
+
+    return Engine(*parse(layers, lambda name: weights[name]))
+
+def time_stage(function, repeats = REPEATS):
+    '''Runs a function once to warm up, then returns the median, 95th
+    percentile and fastest of its timings, in seconds'''
+
+    function()
+
+    times = np.empty(repeats)
+
+    for i in range(repeats):
+        start = perf_counter()
+        function()
+        times[i] = perf_counter() - start
+
+    return {'median': float(np.median(times)), 'p95': float(np.percentile(times, 95)), 'min': float(times.min())}
+
+def bench_hot_path(frames, model, resample = RESAMPLE, batch_sizes = BATCH_SIZES, repeats = REPEATS):
+    '''Times each stage between a captured frame and the motors, and a whole
+    AutoDriver iteration, at each batch size, shrinking frames with the
+    resampling method the car drives the model with. Returns the timings by stage'''
+
+    from car import PWMCar
+    from stub_gpio import StubGPIO
+    from autodriver import AutoDriver
+
+    car = PWMCar(forward = 18, backward = 23, right = 14, left = 15, speed = 0.8, gpio = StubGPIO())
+    driver = AutoDriver(car, None, model, resample = resample, start = False)
+
+    results = {}
+
+    try:
+        from camera import Frame
+
+        results['jpeg/1'] = time_stage(lambda: Frame(0, time(), frames[0]).jpeg(), repeats)
+    except ImportError:
+        print('PIL is not installed, skipping jpeg encoding')
+
+    actions = [car.left, car.right, car.straight]
+    count = [0]
+
+    def actuate():
+        actions[count[0] % 3]()
+        count[0] += 1
+
+    results['actuate/1'] = time_stage(actuate, repeats)
+
+    for n in batch_sizes:
+        batch = frames[:n]
+        small = reduce_dim(batch, SCALE, resample)
+        prepared = prep_images(small)
+
+        def iteration():
+            '''Prepares each frame like the driver, decides on them together,
+            and steers by every decision'''
+
+            images = np.concatenate([driver.prepare(frame) for frame in batch])
+
+            for decision in np.argmax(model.predict(images), axis = 1):
+                driver.steer(decision)
+
+        results['reduce_dim/%d' % n] = time_stage(lambda: reduce_dim(batch, SCALE, resample), repeats)
+        results['prep_images/%d' % n] = time_stage(lambda: prep_images(small), repeats)
+        results['predict/%d' % n] = time_stage(lambda: model.predict(prepared), repeats)
+        results['iteration/%d' % n] = time_stage(iteration, repeats)
+
+    return results
+
+def bench_dataset(directory, frames, sessions = SESSIONS, length = SESSION_LENGTH):
+    '''Records synthetic sessions and times building a dataset from them.
+    Returns the throughput, and the path of the dataset'''
+
+    from process import make_dataset
+
+    inputdir = os.path.join(directory, 'images')
+    outputdir = os.path.join(directory, 'datasets')
+
+    for i in range(sessions):
+        writer = session.SessionWriter(os.path.join(inputdir, 'session%02d' % i))
+
+        for row in range(length):
+            writer.add(frames[(i * length + row) % len(frames)], row % 3, row * 0.05)
+
+        writer.close()
+        writer.join()
+
+    start = perf_counter()
+    make_dataset(inputdir, outputdir, SCALES)
+    elapsed = perf_counter() - start
+
+    return {'images_per_second': sessions * length / elapsed, 'seconds': elapsed}, outputdir
+
+def bench_train(directory, dataset, epochs = TRAIN_EPOCHS):
+    '''Times training model A on a dataset, including compiling it. Returns
+    None if keras is not installed'''
+
+    try:
+        from train import train, BATCH_SIZE, VAL_SPLIT
+        from models import modelA
+    except ImportError:
+        print('keras is not installed, skipping training')
+        return None
+
+    from process import load_dataset
+
+    images, labels, _ = load_dataset(dataset, SCALE)
+    size = int(RESOLUTION / SCALE)
+
+    model = modelA(input_shape = (size, size, 1))
+    steps = epochs * int(np.ceil(len(labels) * (1 - VAL_SPLIT) / BATCH_SIZE))
+
+    start = perf_counter()
+    train(model, images, labels, os.path.join(directory, 'model'), epochs = epochs, verbose = 0, seed = SEED)
+    elapsed = perf_counter() - start
+
+    return {'steps_per_second': steps / elapsed, 'seconds': elapsed}
+
+def benchmark(recorded = None, batch_sizes = BATCH_SIZES, repeats = REPEATS, skip_train = False):
+    '''Runs every benchmark, and returns the results'''
+
+    from runners import load
+
+    frames = recorded_frames(recorded, FRAMES) if recorded else synthetic_frames(FRAMES)
+    resample = read_metadata(MODELPATH).get('resample', RESAMPLE) # Like the controller, not the dataset
+
+    try:
+        model = load(MODELPATH, BACKEND)
+        model_name = MODELPATH
+    except (IOError, OSError):
+        model = synthetic_model()
+        model_name = 'synthetic modelA'
+
+    results = {'meta': {'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'machine': platform.machine(),
+                        'processor': platform.processor(),
+                        'frames': recorded or 'synthetic',
+                        'model': model_name,
+                        'backend': BACKEND,
+                        'resample': resample,
+                        'repeats': repeats},
+               'stages': bench_hot_path(frames, model, resample, batch_sizes, repeats),
+               'throughput': {}}
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        results['throughput']['make_dataset'], dataset = bench_dataset(directory, synthetic_frames(FRAMES * 4))
+
+        if not skip_train:
+            trained = bench_train(directory, dataset)
+
+            if trained is not None:
+                results['throughput']['train'] = trained
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+def compare(results, baseline, tolerance = TOLERANCE):
+    '''Compares results with a baseline. Returns a list of (name, ratio)
+    pairs, where the ratio is how many times slower the results are, and
+    the names of the ones that are slower by more than the tolerance. Stages
+    are compared by their fastest run, which is the least noisy timing'''
+
+    ratios = []
+
+    for name, timing in sorted(results['stages'].items()):
+        if name in baseline.get('stages', {}):
+            ratios.append((name, timing['min'] / baseline['stages'][name]['min']))
+
+    for name, throughput in sorted(results['throughput'].items()):
+        if name in baseline.get('throughput', {}):
+            rate = [key for key in throughput if key.endswith('_per_second')][0]
+            ratios.append((name, baseline['throughput'][name][rate] / throughput[rate]))
+
+    return ratios, [name for name, ratio in ratios if ratio > 1 + tolerance]
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmarks the hot path, dataset building and training')
+    parser.add_argument('--recorded', help = 'directory of recorded sessions to take frames from')
+    parser.add_argument('--output', default = OUTPUT, help = 'file the JSON results are written to')
+    parser.add_argument('--compare', help = 'JSON results of an earlier run to compare with')
+    parser.add_argument('--repeats', type = int, default = REPEATS)
+    parser.add_argument('--skip-train', action = 'store_true', help = 'do not benchmark training')
+    args = parser.parse_args()
+
+    results = benchmark(args.recorded, BATCH_SIZES, args.repeats, args.skip_train)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 2)
+
+    for name, timing in sorted(results['stages'].items()):
+        print('{:16} {:10.3f} ms  p95 {:8.3f} ms'.format(name, timing['median'] * 1000, timing['p95'] * 1000))
+
+    for name, throughput in sorted(results['throughput'].items()):
+        print('{:16} {}'.format(name, ', '.join('%s %.1f' % item for item in sorted(throughput.items()))))
+
+    if args.compare is None:
+        return 0
+
+    with open(args.compare) as f:
+        baseline = json.load(f)
+
+    ratios, regressions = compare(results, baseline)
+
+    print('Compared with ' + args.compare + ':')
+
+    for name, ratio in ratios:
+        print('{:16} {:6.2f}x {}'.format(name, ratio, 'REGRESSION' if name in regressions else ''))
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
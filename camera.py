@@ -1,75 +1,152 @@
 '''Defines the Camera class, which provides methods for other systems to
-obtain pictures from the camera. Relies on a generator to return such images'''
+obtain pictures from the camera. A single background thread captures raw
+luma frames from a frame source and publishes the newest one, so any number
+of systems can read it at once. Frames are only encoded as jpeg when the
+remote asks for them'''
 
-from time import sleep
+from time import time
 from io import BytesIO
 from PIL import Image
 
-import picamera
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
 import threading
 
+from sources import PiCameraSource
+from resample import downscale
+
+BUFFERS = 4 # Number of preallocated frame buffers the capture thread cycles through
+
+class Frame:
+    '''A single published camera frame. The sequence number increases by one
+    for every frame captured, and the timestamp is when the capture finished.
+    The luma array belongs to the camera's buffer ring, so it is only valid
+    until the camera cycles back around to it'''
+
+    def __init__(self, seq, timestamp, luma):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.luma = luma
+        self.encoded = None
+
+    def jpeg(self):
+        '''Returns the frame encoded as jpeg. The encoding is done the first
+        time it is requested and shared by every later caller'''
+
+        if self.encoded is None:
+            stream = BytesIO()
+            Image.fromarray(self.luma).save(stream, 'jpeg')
+            self.encoded = stream.getvalue()
+
+        return self.encoded
+
 class Camera:
-    '''A wrapper for the picamera PiCamera class, which allows images to be
-    streamed from the camera like a generator'''
+    '''Wraps a frame source, by default the Raspberry Pi camera. A dedicated
+    capture thread publishes the latest frame into a slot that consumers read
+    without blocking, or wait on until a frame newer than one they have seen exists'''
 
-    def __init__(self, resolution, framerate):
-        self.frame = self.frame_gen()
+    def __init__(self, resolution, framerate, source = None):
         self.resolution = resolution
         self.framerate = framerate
-        self.lock = threading.Lock()
+        self.source = source if source is not None else PiCameraSource()
 
-    def frame_gen(self):
-        '''Frames are captured from the camera in this generator. The resolution
-        and framerate are set, and the camera takes black and white images.'''
+        self.frame = None # The latest published Frame, replaced on every capture
+        self.buffers = np.empty((BUFFERS, resolution, resolution), dtype = np.uint8)
+        self.condition = threading.Condition() # Wakes consumers waiting for a new frame
 
-        with picamera.PiCamera() as camera:
-            camera.resolution = (self.resolution, self.resolution)
-            camera.framerate = self.framerate
-            camera.color_effects = (128, 128) # Makes the output black and white
+        thread = threading.Thread(target = self.run)
+        thread.daemon = True
 
-            sleep(1) # Camera warm-up time
+        thread.start()
 
-            stream = BytesIO()
+    def run(self):
+        '''The capture thread. It is the only consumer of the generator, and
+        copies each frame into the next buffer of the ring before publishing it
+        with a sequence number and capture timestamp'''
+
+        for seq, plane in enumerate(self.source.frames(self.resolution, self.framerate)):
+            luma = self.buffers[seq % BUFFERS]
+            luma[:] = plane
+
+            self.publish(Frame(seq, time(), luma))
+
+    def publish(self, frame):
+        '''Replaces the latest frame. Swapping the reference is atomic, so
+        readers of self.frame never see a partially written frame'''
+
+        self.frame = frame
+
+        with self.condition:
+            self.condition.notify_all()
 
-            for _ in camera.capture_continuous(stream, 'jpeg', use_video_port = True):
-                stream.seek(0)
+    def latest(self):
+        '''Returns the latest frame without blocking, or None if the camera
+        has not captured anything yet'''
 
-                yield stream.read()
+        return self.frame
 
-                stream.seek(0)
-                stream.truncate()
+    def wait_frame(self, seq = -1, timeout = None):
+        '''Blocks until a frame with a sequence number greater than seq has been
+        published, then returns the newest frame. Returns None on timeout'''
+
+        frame = self.frame
+
+        if frame is not None and frame.seq > seq:
+            return frame
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame is not None and self.frame.seq > seq, timeout)
+
+        frame = self.frame
+
+        if frame is not None and frame.seq > seq:
+            return frame
+
+        return None
 
     def binary(self):
         '''Returns the binary jpeg information from the last camera frame.
         The jpeg data is used to display an image on the remote'''
 
-        with self.lock: # Locking the thread prevents multiple systems from accessing the camera at once
-            return next(self.frame)
+        return self.wait_frame().jpeg()
 
-    def array(self):
-        '''Returns the raw array of pixel values from the last camera frame.
-        This array is used by the model to determine the steering direction'''
+    def stream(self):
+        '''Yields each new frame as one part of a multipart jpeg (MJPEG) stream.
+        A viewer that is slow to receive a frame simply gets the newest frame
+        next, so frames are dropped for it instead of queueing up'''
 
-        binary = self.binary()
+        seq = -1
 
-        pil = Image.open(BytesIO(binary))
-        arr = np.asarray(pil) # Converts the jpeg image format to a raw array format
+        while True:
+            frame = self.wait_frame(seq, timeout = 1)
 
-        return arr[:,:,0] # Only return one of the black and white color chanels
+            if frame is None:
+                continue
+
+            seq = frame.seq
+            jpeg = frame.jpeg()
+
+            yield (b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' +
+                   str(len(jpeg)).encode() + b'\r\n\r\n' + jpeg + b'\r\n')
+
+    def array(self):
+        '''Returns a copy of the raw array of pixel values from the last camera
+        frame. This array is used by the model to determine the steering direction'''
+
+        return self.wait_frame().luma.copy()
 
 # These functions are for testing purposes:
 
-def reduce_dim(arr, factor):
-    '''Reduces the dimensions of a 2D numpy array image by slicing the array with
-    a step parameter. To cut from 64x64 to 32x32 use a factor of 2'''
+def reduce_dim(arr, factor, method = 'mean'):
+    '''Reduces the dimensions of a 2D numpy array image the same way the
+    datasets are shrunk. To cut from 64x64 to 32x32 use a factor of 2'''
 
-    return arr[::factor, ::factor]
+    return downscale(arr, factor, method)
 
 def preview_arr(arr):
-    '''Opens a preview of an array in matplotlib'''
+    '''Opens a preview of an array in matplotlib. matplotlib is slow to import,
+    so it is only imported here, and not when the car starts'''
+
+    import matplotlib.pyplot as plt
 
     plt.imshow(arr, cmap = 'gray', interpolation = 'nearest')
     plt.show()
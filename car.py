@@ -1,29 +1,42 @@
 '''Defines classes for motors and cars, including pulse-width
 modulation versions of both'''
 
-import RPi.GPIO as GPIO
-import time
-
-GPIO.setmode(GPIO.BCM)
-GPIO.setwarnings(False)
+from time import time
+from threading import Thread, Condition
+from collections import deque
 
 HERTZ = 100 # Hertz for the PWM control
 POWERUPTIME = 0.01 # Time to let motors warm up
+COUNTERSTEER = 0.01 # Time the steering motor is pulsed the other way before stopping
+LOGSIZE = 1000 # Number of recent actuations kept in memory
+
+def default_gpio():
+    '''Imports and configures the Raspberry Pi GPIO library the first time a
+    motor needs it, so that this module can be imported off the car'''
+
+    import RPi.GPIO as GPIO
+
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setwarnings(False)
+
+    return GPIO
 
 class Motor(object):
     '''This class is a bare-bones recreation of the gpiozero
     motor class, and allows the motor to run properly during
     a flask application. Also stores a status when the motor
-    direction is changed.'''
+    direction is changed. Drives the Raspberry Pi's GPIO pins unless
+    another GPIO backend, like StubGPIO, is given.'''
 
-    def __init__(self, forward, backward):
+    def __init__(self, forward, backward, gpio = None):
         self.status = 'off' # Tracks the status of the motor
+        self.gpio = gpio if gpio is not None else default_gpio()
 
         self.forwardPin = forward
         self.backwardPin = backward
 
-        GPIO.setup(forward, GPIO.OUT)
-        GPIO.setup(backward, GPIO.OUT)
+        self.gpio.setup(forward, self.gpio.OUT)
+        self.gpio.setup(backward, self.gpio.OUT)
 
     def get_status(self):
         return self.status
@@ -31,29 +44,31 @@ class Motor(object):
     def forward(self):
         self.status = 'forward'
 
-        GPIO.output(self.forwardPin, GPIO.HIGH)
-        GPIO.output(self.backwardPin, GPIO.LOW)
+        self.gpio.output(self.forwardPin, self.gpio.HIGH)
+        self.gpio.output(self.backwardPin, self.gpio.LOW)
 
     def backward(self):
         self.status = 'backward'
 
-        GPIO.output(self.forwardPin, GPIO.LOW)
-        GPIO.output(self.backwardPin, GPIO.HIGH)
+        self.gpio.output(self.forwardPin, self.gpio.LOW)
+        self.gpio.output(self.backwardPin, self.gpio.HIGH)
 
     def stop(self):
         self.status = 'off'
 
-        GPIO.output(self.forwardPin, GPIO.LOW)
-        GPIO.output(self.backwardPin, GPIO.LOW)
+        self.gpio.output(self.forwardPin, self.gpio.LOW)
+        self.gpio.output(self.backwardPin, self.gpio.LOW)
 
 class PWMMotor(Motor):
     '''This class is similar to the Motor class, but uses pulse-
-    width modulation to control the speed of the motor'''
-
-    def __init__(self, forward, backward):
-        super().__init__(forward = forward, backward = backward)
-        self.forwardPWM = GPIO.PWM(self.forwardPin, HERTZ)
-        self.backwardPWM = GPIO.PWM(self.backwardPin, HERTZ)
+    width modulation to control the speed of the motor. The motor
+    changes speed immediately; giving it a burst of full power to
+    start is left to the Actuator that drives it.'''
+
+    def __init__(self, forward, backward, gpio = None):
+        super().__init__(forward = forward, backward = backward, gpio = gpio)
+        self.forwardPWM = self.gpio.PWM(self.forwardPin, HERTZ)
+        self.backwardPWM = self.gpio.PWM(self.backwardPin, HERTZ)
         self.forwardPWM.start(0)
         self.backwardPWM.start(0)
 
@@ -61,20 +76,12 @@ class PWMMotor(Motor):
         self.status = 'forward'
 
         self.backwardPWM.ChangeDutyCycle(0)
-        self.forwardPWM.ChangeDutyCycle(100)
-
-        time.sleep(POWERUPTIME) # Allow motor to receive enough power to start
-
         self.forwardPWM.ChangeDutyCycle(speed * 100)
 
     def backward(self, speed = 1):
         self.status = 'backward'
 
         self.forwardPWM.ChangeDutyCycle(0)
-        self.backwardPWM.ChangeDutyCycle(100)
-
-        time.sleep(POWERUPTIME) # Allow motor to receive enough power to start
-
         self.backwardPWM.ChangeDutyCycle(speed * 100)
 
     def stop(self):
@@ -83,15 +90,134 @@ class PWMMotor(Motor):
         self.forwardPWM.ChangeDutyCycle(0)
         self.backwardPWM.ChangeDutyCycle(0)
 
+class Actuator:
+    '''Owns the motors on a dedicated thread, so that callers never wait on
+    them. Each motor has a latest-wins command slot: a command replaces any
+    command for that motor that has not been carried out yet, and a command
+    that matches the motor's current one is dropped. A command is carried
+    out as a program of timed steps, like a burst of power followed by the
+    running speed, which the thread runs without sleeping in between.'''
+
+    def __init__(self):
+        self.programs = {} # Functions that turn a command into timed steps, for each motor
+
+        self.pending = {} # The latest command for each motor that has not been started
+        self.targets = {} # The command each motor is carrying out, or has carried out
+        self.steps = {} # Steps of each motor's program that are not due yet
+
+        self.coalesced = 0 # Commands replaced before starting, or already being carried out
+        self.log = deque(maxlen = LOGSIZE) # Recent (time, motor, step) actuations
+
+        self.condition = Condition()
+
+        thread = Thread(target = self.run)
+        thread.daemon = True
+
+        thread.start()
+
+    def register(self, motor, program):
+        '''Registers the program of a motor. A program is a function taking the
+        new and previous commands, and returning a list of (delay, step, function)
+        tuples. Each function is called delay seconds after the command starts'''
+
+        self.programs[motor] = program
+
+    def command(self, motor, action):
+        '''Sets the latest command for a motor, and returns immediately'''
+
+        with self.condition:
+            if motor in self.pending:
+                self.coalesced += 1 # Replaced before it was started
+
+            self.pending[motor] = action
+            self.condition.notify()
+
+    def next_due(self):
+        '''Returns when the next step of any program is due, or None'''
+
+        dues = [steps[0][0] for steps in self.steps.values() if steps]
+
+        return min(dues) if dues else None
+
+    def run(self):
+        '''The actuator thread. Sleeps until a command arrives or the next step
+        of a program is due, then starts new commands and runs due steps'''
+
+        while True:
+            with self.condition:
+                while not self.pending:
+                    due = self.next_due()
+
+                    if due is None:
+                        self.condition.wait()
+                    elif due <= time():
+                        break
+                    else:
+                        self.condition.wait(due - time())
+
+                pending = self.pending
+                self.pending = {}
+
+            now = time()
+
+            for motor, action in pending.items():
+                self.start(motor, action, now)
+
+            self.advance(time())
+
+    def start(self, motor, action, now):
+        '''Replaces a motor's program with the program for a new command'''
+
+        previous = self.targets.get(motor)
+
+        if action == previous:
+            self.coalesced += 1
+            return
+
+        self.targets[motor] = action
+        self.steps[motor] = deque((now + delay, step, function) for delay, step, function in self.programs[motor](action, previous))
+
+    def advance(self, now):
+        '''Runs every step that is due. A step that fails is logged, and the
+        rest of that motor's program is dropped and its command forgotten, so
+        the same command can be sent again, and one bad step cannot stop the
+        thread that carries out every motor's commands'''
+
+        for motor, steps in self.steps.items():
+            while steps and steps[0][0] <= now:
+                _, step, function = steps.popleft()
+
+                try:
+                    function()
+                except Exception as e:
+                    print('Actuator step ' + str(step) + ' of the ' + str(motor) + ' motor failed: ' + repr(e))
+                    steps.clear()
+                    self.targets.pop(motor, None)
+                    break
+
+                self.log.append((time(), motor, step))
+
+    def actuations(self):
+        '''Returns the recent actuations as a list of (time, motor, step) tuples'''
+
+        return list(self.log)
+
 class Car:
     '''This class creates an instance of a simple, wheeled robot
     that uses one motor to control forward/backward movement, and
     one motor that controls the steering of the car. Can report
-    the status of both the steer and drive motors.'''
+    the status of both the steer and drive motors. Commands are
+    carried out by an Actuator, so none of them block the caller.'''
+
+    def __init__(self, forward, backward, left, right, gpio = None):
+        self.gpio = gpio if gpio is not None else default_gpio()
 
-    def __init__(self, forward, backward, left, right):
-        self.driveMotor = Motor(forward = forward, backward = backward)
-        self.steerMotor = Motor(forward = left, backward = right)
+        self.driveMotor = Motor(forward = forward, backward = backward, gpio = self.gpio)
+        self.steerMotor = Motor(forward = left, backward = right, gpio = self.gpio)
+
+        self.actuator = Actuator()
+        self.actuator.register('drive', self.drive_program)
+        self.actuator.register('steer', self.steer_program)
 
     def get_status(self):
         '''Returns a tuple (drive status, steer status) the defines
@@ -112,33 +238,45 @@ class Car:
 
         return (drive_status, steer_status)
 
-    def straight(self):
+    def steer_program(self, action, previous):
+        '''Returns the steps that turn the steering motor for a command'''
+
+        if action == 'left':
+            return [(0, 'left', self.steerMotor.forward)]
+        if action == 'right':
+            return [(0, 'right', self.steerMotor.backward)]
+
         # Briefly turn the motor in the opposite direction before steering straight
-	# This allows the steering pin to build momentum to steer the car
-        steer_status = self.get_status()[1]
+        # This allows the steering pin to build momentum to steer the car
+        if previous == 'left':
+            return [(0, 'counter', self.steerMotor.backward), (COUNTERSTEER, 'straight', self.steerMotor.stop)]
+        if previous == 'right':
+            return [(0, 'counter', self.steerMotor.forward), (COUNTERSTEER, 'straight', self.steerMotor.stop)]
+
+        return [(0, 'straight', self.steerMotor.stop)]
 
-        if(steer_status == 'left'):
-            self.right()
-        if(steer_status == 'right'):
-            self.left()
+    def drive_program(self, action, previous):
+        '''Returns the steps that run the drive motor for a command'''
 
-        time.sleep(0.01)
-        self.steerMotor.stop()
+        return [(0, action, getattr(self.driveMotor, action))]
+
+    def straight(self):
+        self.actuator.command('steer', 'straight')
 
     def left(self):
-        self.steerMotor.forward()
+        self.actuator.command('steer', 'left')
 
     def right(self):
-        self.steerMotor.backward()
+        self.actuator.command('steer', 'right')
 
     def stop(self):
-        self.driveMotor.stop()
+        self.actuator.command('drive', 'stop')
 
     def forward(self):
-        self.driveMotor.forward()
+        self.actuator.command('drive', 'forward')
 
     def backward(self):
-        self.driveMotor.backward()
+        self.actuator.command('drive', 'backward')
 
 class PWMCar(Car):
     '''A modified version of the Car class, that uses a PWM Motor as
@@ -146,14 +284,19 @@ class PWMCar(Car):
     class, but replaces the drive motor with a PWMMotor, and proper
     methods to control the speed of such motor.'''
 
-    def __init__(self, forward, backward, left, right, speed):
-        Car.__init__(self, forward, backward, left, right)
+    def __init__(self, forward, backward, left, right, speed, gpio = None):
+        Car.__init__(self, forward, backward, left, right, gpio)
 
-        self.driveMotor = PWMMotor(forward, backward)
+        self.driveMotor = PWMMotor(forward, backward, self.gpio)
         self.speed = speed
 
-    def forward(self):
-        self.driveMotor.forward(self.speed)
+    def drive_program(self, action, previous):
+        '''Starts the drive motor at full power, so it receives enough power
+        to start, and drops it to the car's speed once it is running'''
 
-    def backward(self):
-        self.driveMotor.backward(self.speed)
+        if action == 'stop':
+            return [(0, 'stop', self.driveMotor.stop)]
+
+        run = getattr(self.driveMotor, action)
+
+        return [(0, 'kick', lambda: run(1)), (POWERUPTIME, action, lambda: run(self.speed))]
@@ -0,0 +1,77 @@
+'''Defines the ControlChannel class, which carries drive commands from the
+remote to the car and streams the car's status back. Commands are numbered
+by each remote, so late or repeated commands can be dropped instead of
+undoing a newer one of the same kind.'''
+
+import json
+
+from threading import Lock, Condition
+
+INTERVAL = 0.5 # Longest time between status updates sent to a remote
+
+# Commands on different channels never replace each other, so a late drive
+# command is only dropped if a newer drive command has already been applied
+CHANNELS = {'forward': 'drive', 'backward': 'drive', 'stop': 'drive',
+            'left': 'steer', 'right': 'steer', 'straight': 'steer',
+            'record': 'record', 'auto': 'auto'}
+
+
+class ControlChannel:
+    '''Applies sequenced commands, and builds the server-sent event stream
+    of status updates that each remote listens to'''
+
+    def __init__(self, commands, status):
+        '''Takes a dict that maps command names to the functions that carry
+        them out, and a function that returns the car's status as a dict'''
+
+        self.commands = commands
+        self.status = status
+
+        self.latest = {} # The last sequence number applied for each remote and channel
+        self.dropped = 0 # Commands dropped because a newer one was already applied
+
+        self.lock = Lock() # Applies commands one at a time, in the order they are accepted
+        self.condition = Condition() # Wakes the status streams when something changes
+        self.version = 0
+
+    def submit(self, client, seq, cmd):
+        '''Applies a command from a remote, unless that remote has already had a
+        command on the same channel with the same or a later sequence number
+        applied. Returns whether the command was applied'''
+
+        if cmd not in self.commands:
+            raise KeyError('Unknown command ' + cmd)
+
+        key = (client, CHANNELS.get(cmd, cmd))
+
+        with self.lock:
+            if seq <= self.latest.get(key, 0):
+                self.dropped += 1
+                return False
+
+            self.latest[key] = seq
+            self.commands[cmd]()
+
+        self.changed()
+
+        return True
+
+    def changed(self):
+        '''Tells every status stream that the car's status has changed'''
+
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def events(self, interval = INTERVAL):
+        '''Yields the car's status as server-sent events, right after every
+        change, and at least every interval seconds otherwise'''
+
+        version = -1
+
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.version != version, interval)
+                version = self.version
+
+            yield 'data: ' + json.dumps(self.status()) + '\n\n'
@@ -0,0 +1,116 @@
+'''Defines the Controller class, which builds and owns the systems that drive
+the car around a camera: the car itself, the recorder, the model registry
+and the autodriver. The remote control talks to the car only through a
+controller, whether it runs in the same process or in another one.'''
+
+from time import perf_counter
+
+from car import PWMCar
+from metrics import Metrics
+from recorder import Recorder
+from registry import Registry
+from autodriver import AutoDriver, ChangeGate
+
+MODELDIR = 'models'
+MODEL = 'modelA6' # The model the car starts with. Others can be selected on the remote
+RESAMPLE = 'slice' # modelA6 was trained on sliced images. Newer models record theirs in their metadata
+BACKEND = 'numpy' # Export the model with engine.py first. Use 'keras' for the reference runner
+
+COMMANDS = ['left', 'right', 'forward', 'backward', 'stop', 'straight', 'record', 'auto']
+
+
+class Controller:
+    '''Builds the car, recorder, model registry and autodriver, and gives the
+    remote the commands it can send, the status it shows, and the metrics.
+    The model is loaded and warmed up in the background, so the car can be
+    driven by hand straight away, and auto mode is available once it is ready'''
+
+    def __init__(self, camera, gpio = None, model = MODEL, modeldir = MODELDIR, backend = BACKEND):
+        start = perf_counter()
+
+        self.camera = camera
+        self.metrics = Metrics()
+        self.changed = lambda: None # Called when the status changes outside of a command
+        self.timings = {} # Seconds each phase of starting up took
+
+        self.car = PWMCar(forward = 18, backward = 23, right = 14, left = 15, speed = 0.8, gpio = gpio)
+        self.recorder = Recorder(car = self.car, camera = camera, interval = 0.05)
+
+        self.registry = Registry(modeldir, backend)
+        self.autodriver = AutoDriver(car = self.car, camera = camera, model = None, deadline = 0.05, metrics = self.metrics,
+                                     gate = ChangeGate(), resample = RESAMPLE)
+
+        self.metrics.counter('actuator_coalesced', lambda: self.car.actuator.coalesced)
+        self.metrics.counter('camera_frames', lambda: camera.frame.seq + 1 if camera.frame is not None else 0)
+
+        # Shortcuts to convert the command path to the function
+        self.commands = {'left': self.car.left,
+                         'right': self.car.right,
+                         'forward': self.car.forward,
+                         'backward': self.car.backward,
+                         'stop': self.car.stop,
+                         'straight': self.car.straight,
+                         'record': self.recorder.toggle_record,
+                         'auto': self.autodriver.toggle_auto}
+
+        self.timings['controller'] = perf_counter() - start
+
+        self.loading = perf_counter() # When the first model started loading
+
+        try:
+            self.registry.select(model, self.swap)
+        except KeyError:
+            print('Could not find ' + model + ' in ' + modeldir + ', auto mode is unavailable')
+
+    def swap(self, runner, info, activate):
+        '''Hands a loaded model to the autodriver, on the registry's thread. The
+        autodriver may wait for the frame it is deciding on before swapping,
+        so the registry is only told the model is active once it is driving'''
+
+        def swapped():
+            activate()
+
+            if 'model' not in self.timings:
+                self.timings['model'] = perf_counter() - self.loading
+                print('Model ready after {:.2f} s, auto mode is available'.format(self.timings['model']))
+
+            self.changed()
+
+        self.autodriver.set_model(runner, info.get('resample', RESAMPLE), swapped)
+
+    def status(self):
+        '''The status streamed to the remote: the state of the motors, the
+        recording and auto modes, the models, and a summary of the control metrics.'''
+
+        drive_status, steer_status = self.car.get_status()
+
+        return {'drive': drive_status,
+                'steer': steer_status,
+                'recording': self.recorder.recording,
+                'auto': self.autodriver.auto,
+                'ready': self.autodriver.model is not None,
+                'model': self.registry.active,
+                'loading': self.registry.loading,
+                'model_error': self.registry.error,
+                'startup': self.timings,
+                'metrics': self.metrics.summary()}
+
+    def models(self):
+        '''Returns the models the car can drive with, and which is in use'''
+
+        return {'models': self.registry.index(),
+                'active': self.registry.active,
+                'loading': self.registry.loading,
+                'error': self.registry.error}
+
+    def select_model(self, name):
+        '''Starts loading a model to swap in for the one driving the car.
+        Returns False if another model is still loading, and raises a
+        KeyError for a model that does not exist'''
+
+        return self.registry.select(name, self.swap)
+
+    def render_metrics(self):
+        '''Returns the metrics in the Prometheus text format'''
+
+        return self.metrics.render()
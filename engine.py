@@ -0,0 +1,300 @@
+'''Defines the Engine class, a pure numpy implementation of the forward pass
+of the models in models.py. It loads the weights saved by keras and runs the
+layers in float32, so the car can make decisions without importing keras or
+tensorflow. This file is run to export a saved keras model to a .npz file,
+which can then be loaded with nothing but numpy.'''
+
+import json
+import numpy as np
+
+from threading import Lock
+
+from runners import Runner
+
+MODELPATH = 'models/modelA6'
+
+
+class Engine(Runner):
+    '''Runs a list of layers as vectorized numpy. The activation buffers are
+    allocated once for each batch size, and every layer writes into them in
+    place, so making a decision does not allocate any image-sized arrays.'''
+
+    def __init__(self, layers, input_shape):
+        self.layers = layers
+        self.input_shape = tuple(input_shape)
+
+        self.batch = None # Batch size the buffers are currently allocated for
+        self.lock = Lock()
+
+    def plan(self, batch):
+        '''Allocates the activation buffers for a batch size, and builds the
+        list of steps that run each layer on them'''
+
+        self.steps = []
+        self.input = np.empty((batch,) + self.input_shape, dtype = np.float32)
+
+        x = self.input
+
+        for layer in self.layers:
+            kind = layer['type']
+
+            if kind == 'conv':
+                x = self.conv(x, layer['kernel'], layer['bias'], layer['padding'])
+                self.activation(x, layer['activation'])
+            elif kind == 'dense':
+                x = self.dense(x, layer['kernel'], layer['bias'])
+                self.activation(x, layer['activation'])
+            elif kind == 'activation':
+                self.activation(x, layer['activation'], layer.get('alpha'))
+            elif kind == 'pool':
+                x = self.pool(x, layer['size'], layer['padding'])
+            elif kind == 'flatten':
+                x = x.reshape(batch, -1)
+
+        self.output = x
+        self.batch = batch
+
+    def conv(self, x, kernel, bias, padding):
+        '''Adds a step that convolves x with the kernel, using im2col: the
+        windows of the input are copied into one matrix, and a single matrix
+        multiplication computes every output pixel at once'''
+
+        n, h, w, c = x.shape
+        kh, kw, _, filters = kernel.shape
+
+        if padding == 'same':
+            padded = np.zeros((n, h + kh - 1, w + kw - 1, c), dtype = np.float32)
+            interior = padded[:, (kh - 1) // 2:(kh - 1) // 2 + h, (kw - 1) // 2:(kw - 1) // 2 + w]
+            oh, ow = h, w
+        else:
+            padded = x
+            interior = None
+            oh, ow = h - kh + 1, w - kw + 1
+
+        columns = np.empty((n, oh, ow, kh, kw, c), dtype = np.float32)
+        out = np.empty((n, oh, ow, filters), dtype = np.float32)
+
+        matrix = kernel.reshape(kh * kw * c, filters)
+        columns2d = columns.reshape(n * oh * ow, kh * kw * c)
+        out2d = out.reshape(n * oh * ow, filters)
+
+        def step():
+            if interior is not None:
+                interior[...] = x
+
+            for i in range(kh):
+                for j in range(kw):
+                    columns[:, :, :, i, j, :] = padded[:, i:i + oh, j:j + ow, :]
+
+            np.matmul(columns2d, matrix, out = out2d)
+            np.add(out2d, bias, out = out2d)
+
+        self.steps.append(step)
+
+        return out
+
+    def dense(self, x, kernel, bias):
+        '''Adds a step that multiplies x by the dense layer's weights'''
+
+        out = np.empty((x.shape[0], kernel.shape[1]), dtype = np.float32)
+
+        def step():
+            np.matmul(x, kernel, out = out)
+            np.add(out, bias, out = out)
+
+        self.steps.append(step)
+
+        return out
+
+    def pool(self, x, size, padding):
+        '''Adds a step that max pools x with a stride equal to the pool size.
+        Like keras, "same" padding pads the bottom and right edges'''
+
+        n, h, w, c = x.shape
+
+        if padding == 'same':
+            oh, ow = -(-h // size), -(-w // size)
+        else:
+            oh, ow = h // size, w // size
+
+        if padding == 'same' and (oh * size, ow * size) != (h, w):
+            source = np.full((n, oh * size, ow * size, c), -np.inf, dtype = np.float32)
+            interior = source[:, :h, :w]
+        else:
+            source = x[:, :oh * size, :ow * size]
+            interior = None
+
+        out = np.empty((n, oh, ow, c), dtype = np.float32)
+
+        def step():
+            if interior is not None:
+                interior[...] = x
+
+            out[...] = source[:, 0::size, 0::size]
+
+            for i in range(size):
+                for j in range(size):
+                    if i or j:
+                        np.maximum(out, source[:, i::size, j::size], out = out)
+
+        self.steps.append(step)
+
+        return out
+
+    def activation(self, x, name, alpha = None):
+        '''Adds a step that applies an activation to x in place'''
+
+        if name == 'linear':
+            return
+
+        if name == 'leaky':
+            scaled = np.empty_like(x)
+
+            def step():
+                np.multiply(x, alpha, out = scaled)
+                np.maximum(x, scaled, out = x)
+        elif name == 'relu':
+            def step():
+                np.maximum(x, 0, out = x)
+        elif name == 'softmax':
+            def step():
+                np.subtract(x, x.max(axis = -1, keepdims = True), out = x)
+                np.exp(x, out = x)
+                np.divide(x, x.sum(axis = -1, keepdims = True), out = x)
+        else:
+            raise ValueError('Unsupported activation ' + name)
+
+        self.steps.append(step)
+
+    def predict(self, images):
+        '''Returns the class probabilities for a batch of prepared images'''
+
+        with self.lock:
+            if len(images) != self.batch:
+                self.plan(len(images))
+
+            self.input[...] = images
+
+            for step in self.steps:
+                step()
+
+            return self.output.copy()
+
+    @classmethod
+    def load(cls, path):
+        '''Loads an engine from a .npz file written by export, or straight
+        from a saved keras model if h5py is installed'''
+
+        if path.endswith('.npz'):
+            with np.load(path) as data:
+                config = json.loads(str(data['config']))
+                weights = {name: data[name] for name in data.files if name != 'config'}
+
+            return cls(*parse(config, lambda name: [weights[key] for key in sorted(weights) if key.startswith(name + '/')]))
+
+        config, weights = read_keras(path)
+
+        return cls(*parse(config, lambda name: weights[name]))
+
+def read_keras(path):
+    '''Reads the layer configs and weights of a model saved by keras' model.save.
+    Returns the list of layer configs, and a dict of each layer's weight arrays'''
+
+    import h5py
+
+    with h5py.File(path, 'r') as f:
+        config = f.attrs['model_config']
+        config = json.loads(config.decode('utf-8') if isinstance(config, bytes) else config)
+
+        layers = config['config']
+        if isinstance(layers, dict): # Newer versions of keras wrap the layer list
+            layers = layers['layers']
+
+        group = f['model_weights'] if 'model_weights' in f else f
+        weights = {}
+
+        for layer in layers:
+            name = layer['config']['name']
+
+            if name in group:
+                names = [n.decode('utf-8') if isinstance(n, bytes) else n for n in group[name].attrs['weight_names']]
+                weights[name] = [np.array(group[name][n], dtype = np.float32) for n in names]
+
+    return layers, weights
+
+def parse(layers, weights):
+    '''Converts keras layer configs into the engine's layer list. Dropout does
+    nothing at inference time, so it is left out. Returns (layers, input_shape)'''
+
+    parsed = []
+    input_shape = None
+
+    for layer in layers:
+        kind = layer['class_name']
+        config = layer['config']
+
+        if input_shape is None and 'batch_input_shape' in config:
+            input_shape = config['batch_input_shape'][1:]
+
+        if kind == 'Conv2D':
+            if tuple(config['strides']) != (1, 1):
+                raise ValueError('Only convolutions with a stride of 1 are supported')
+
+            kernel, bias = layer_weights(weights(config['name']), config)
+            parsed.append({'type': 'conv', 'kernel': kernel, 'bias': bias,
+                           'padding': config['padding'], 'activation': config['activation']})
+        elif kind == 'Dense':
+            kernel, bias = layer_weights(weights(config['name']), config)
+            parsed.append({'type': 'dense', 'kernel': kernel, 'bias': bias, 'activation': config['activation']})
+        elif kind == 'LeakyReLU':
+            parsed.append({'type': 'activation', 'activation': 'leaky', 'alpha': np.float32(config['alpha'])})
+        elif kind == 'Activation':
+            parsed.append({'type': 'activation', 'activation': config['activation']})
+        elif kind == 'MaxPooling2D':
+            size = config['pool_size'][0]
+
+            if tuple(config['pool_size']) != (size, size) or tuple(config['strides']) != (size, size):
+                raise ValueError('Only square pools with a stride equal to their size are supported')
+
+            parsed.append({'type': 'pool', 'size': size, 'padding': config['padding']})
+        elif kind == 'Flatten':
+            parsed.append({'type': 'flatten'})
+        elif kind in ('Dropout', 'InputLayer'):
+            continue
+        else:
+            raise ValueError('Unsupported layer ' + kind)
+
+    return parsed, input_shape
+
+def layer_weights(arrays, config):
+    '''Returns the (kernel, bias) of a layer as contiguous float32 arrays,
+    with a bias of zeros for layers that do not use one'''
+
+    kernel = np.ascontiguousarray(arrays[0], dtype = np.float32)
+
+    if config.get('use_bias', True):
+        bias = np.ascontiguousarray(arrays[1], dtype = np.float32)
+    else:
+        bias = np.zeros(kernel.shape[-1], dtype = np.float32)
+
+    return kernel, bias
+
+def export(path, output):
+    '''Converts a saved keras model into a .npz file holding the layer configs
+    and the weights, which Engine.load reads with numpy alone'''
+
+    config, weights = read_keras(path)
+    arrays = {'config': np.array(json.dumps(config))}
+
+    for name, values in weights.items():
+        for i, value in enumerate(values):
+            arrays['%s/%03d' % (name, i)] = value
+
+    np.savez(output, **arrays)
+
+def main():
+    export(MODELPATH, MODELPATH + '.npz')
+    print('Exported ' + MODELPATH + ' to ' + MODELPATH + '.npz')
+
+if __name__ == '__main__':
+    main()
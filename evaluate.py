@@ -0,0 +1,244 @@
+'''Replays recorded sessions through the AutoDriver, without a car or a
+camera, and measures how well a model would have driven. Every frame goes
+through the same preprocessing, frame history and change gate as on the
+car, but the model runs on whole batches of frames at once. This file is
+run to check a new model before it is put on the car.'''
+
+import os
+import sys
+import csv
+import json
+import numpy as np
+
+from time import perf_counter
+
+import session
+
+from process import list_sessions, read_manifest
+from runners import load
+from registry import read_metadata
+from controller import RESAMPLE
+from metrics import Metrics
+from autodriver import AutoDriver, ChangeGate
+
+INPUTDIR = 'images'
+DATASET = 'datasets'
+OUTPUTDIR = 'evaluations'
+
+MODELPATH = 'models/modelA6'
+BACKEND = 'numpy'
+
+BATCH_SIZE = 256 # Frames the model runs on at once
+INTERVAL = 0.05 # Seconds between frames of old sessions, which did not record timestamps
+GATE = True # Replays the change gate, like the remote does
+HELD_OUT = True # Only replays sessions that were not entirely trained on
+VAL_SPLIT = 0.1 # The fraction of a dataset train.py holds out for validation
+LATENCY_SAMPLES = 200 # Frames timed one at a time, like the car runs them
+MIN_AGREEMENT = 0.75 # Overall agreement below which the model fails
+
+TARGET_NAMES = ['Left', 'Right', 'Straight']
+
+
+def held_out(names, outputdir):
+    '''Returns the sessions with rows outside the training split of a dataset.
+    Like training, the last fraction of the dataset's rows is for validation,
+    and sessions the dataset has not seen are always held out'''
+
+    manifest = read_manifest(outputdir)
+    boundary = int(manifest['count'] * (1 - VAL_SPLIT))
+    trained = {entry['name'] for entry in manifest['sessions'] if entry['start'] + entry['count'] <= boundary}
+
+    return [name for name in names if name not in trained]
+
+def flip_flops(decisions):
+    '''Returns how many times the steering went straight from left to right or
+    from right to left, without going straight in between'''
+
+    steering = decisions[decisions != 2]
+
+    return int(np.count_nonzero(steering[1:] != steering[:-1]))
+
+def replay(driver, gate, images, timestamps):
+    '''Runs a session's frames through the driver's preprocessing and the
+    gate, in order, and returns the prepared inputs and, for each frame, the
+    index of the frame whose decision it uses. A frame the gate lets through
+    uses its own decision'''
+
+    inputs = np.empty((len(images),) + driver.model.input_shape, dtype = np.float32)
+    sources = np.arange(len(images))
+
+    if driver.history is not None:
+        driver.history.reset()
+
+    for i in range(len(images)):
+        start = perf_counter()
+        prepared = driver.prepare(images[i], timestamps[i])
+        driver.metrics.observe('preprocess', perf_counter() - start)
+
+        inputs[i] = prepared[0]
+
+        if gate is not None:
+            # The gate is given frame indices instead of decisions, so it can be
+            # replayed before the model has run on any of them
+            reused = gate.check(prepared, timestamps[i])
+
+            if reused is None:
+                gate.update(prepared, i, timestamps[i])
+            else:
+                sources[i] = reused
+
+    return inputs, sources
+
+def evaluate_session(driver, path, batch_size = BATCH_SIZE, gate = None):
+    '''Replays one session, and returns its results and decisions'''
+
+    images, labels, timestamps = session.load(path)
+
+    if len(labels) == 0:
+        return None, None
+
+    if not timestamps.any():
+        timestamps = np.arange(len(labels)) * INTERVAL
+
+    inputs, sources = replay(driver, gate, images, timestamps)
+    executed = np.flatnonzero(sources == np.arange(len(sources)))
+
+    probabilities = np.empty((len(inputs), len(TARGET_NAMES)), dtype = np.float32)
+
+    start = perf_counter()
+
+    for row in range(0, len(executed), batch_size):
+        rows = executed[row:row + batch_size]
+        probabilities[rows] = driver.model.predict(inputs[rows])
+
+    elapsed = perf_counter() - start
+
+    decisions = np.argmax(probabilities, axis = 1)[sources]
+    labels = labels.astype(np.int64)
+
+    result = {'session': os.path.basename(path),
+              'frames': len(labels),
+              'executed': len(executed),
+              'agreement': float(np.mean(decisions == labels)),
+              'flip_flops': flip_flops(decisions),
+              'human_flip_flops': flip_flops(labels),
+              'changes': int(np.count_nonzero(decisions[1:] != decisions[:-1])),
+              'frames_per_second': len(executed) / elapsed if elapsed > 0 else float('nan')}
+
+    for i, name in enumerate(TARGET_NAMES):
+        chosen = labels == i
+        result[name + '_recall'] = float(np.mean(decisions[chosen] == i)) if chosen.any() else float('nan')
+
+    return result, (decisions, labels, inputs[executed[:LATENCY_SAMPLES]])
+
+def time_decisions(driver, inputs):
+    '''Times the model on one frame at a time, the way the car runs it'''
+
+    for i in range(len(inputs)):
+        start = perf_counter()
+        driver.model.predict(inputs[i:i + 1])
+        driver.metrics.observe('inference', perf_counter() - start)
+
+def evaluate(model, inputdir, sessions, resample, batch_size = BATCH_SIZE, gate = GATE):
+    '''Replays each session through an AutoDriver that uses the model, and
+    returns the overall results and the results of each session. The
+    resampling method has to be the one the car drives the model with'''
+
+    metrics = Metrics()
+    driver = AutoDriver(None, None, model, metrics = metrics, resample = resample, start = False)
+
+    results = []
+    decisions = []
+    labels = []
+    samples = []
+
+    for name in sessions:
+        result, outputs = evaluate_session(driver, os.path.join(inputdir, name), batch_size,
+                                           ChangeGate() if gate else None)
+
+        if result is None:
+            continue
+
+        results.append(result)
+        decisions.append(outputs[0])
+        labels.append(outputs[1])
+
+        if sum(len(sample) for sample in samples) < LATENCY_SAMPLES:
+            samples.append(outputs[2])
+
+        print('{session}: agreement {agreement:.4f}, {flip_flops} flip-flops ({human_flip_flops} by hand), '
+              '{executed}/{frames} frames run'.format(**result))
+
+    if not results:
+        return None, results
+
+    decisions = np.concatenate(decisions)
+    labels = np.concatenate(labels)
+
+    time_decisions(driver, np.concatenate(samples)[:LATENCY_SAMPLES])
+
+    stages = metrics.summary()['stages']
+    frames = sum(result['frames'] for result in results)
+    executed = sum(result['executed'] for result in results)
+
+    summary = {'sessions': len(results),
+               'frames': frames,
+               'executed': executed,
+               'agreement': float(np.mean(decisions == labels)),
+               'flip_flops': sum(result['flip_flops'] for result in results),
+               'human_flip_flops': sum(result['human_flip_flops'] for result in results),
+               'confusion': np.bincount(labels * len(TARGET_NAMES) + decisions,
+                                        minlength = len(TARGET_NAMES) ** 2).reshape(len(TARGET_NAMES), -1).tolist(),
+               'preprocess': stages['preprocess'],
+               'inference': stages['inference'],
+               'decision_p50': stages['preprocess']['p50'] + stages['inference']['p50']}
+
+    return summary, results
+
+def write_results(summary, results, output):
+    '''Writes the summary and per-session results as JSON, and the per-session
+    results as a CSV table, next to each other'''
+
+    os.makedirs(os.path.dirname(output) or '.', exist_ok = True)
+
+    with open(output + '.json', 'w') as f:
+        json.dump({'summary': summary, 'sessions': results}, f, indent = 2)
+
+    with open(output + '.csv', 'w', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+def main():
+    sessions = list_sessions(INPUTDIR)
+
+    if HELD_OUT:
+        sessions = held_out(sessions, DATASET)
+
+    # The car shrinks frames the way the model's metadata says, or the way
+    # it shrinks them for models from before there was metadata
+    resample = read_metadata(MODELPATH).get('resample', RESAMPLE)
+
+    model = load(MODELPATH, BACKEND)
+    summary, results = evaluate(model, INPUTDIR, sessions, resample)
+
+    if summary is None:
+        print('No sessions to evaluate')
+        return 1
+
+    summary['model'] = MODELPATH
+    summary['resample'] = resample
+    write_results(summary, results, os.path.join(OUTPUTDIR, os.path.basename(MODELPATH)))
+
+    print('Agreement {:.4f} over {} frames, {} flip-flops ({} by hand), {:.3f} ms a decision'.format(
+        summary['agreement'], summary['frames'], summary['flip_flops'], summary['human_flip_flops'],
+        summary['decision_p50'] * 1000))
+
+    if summary['agreement'] < MIN_AGREEMENT:
+        print('Agreement is below ' + str(MIN_AGREEMENT) + ', the model should not be used')
+        return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
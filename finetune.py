@@ -0,0 +1,170 @@
+'''Fine-tunes a trained model on the sessions recorded since it was trained,
+instead of training a new model on everything from scratch. The new
+sessions are added to the dataset, and the model is trained for a few
+epochs on them mixed with a sample of the images it has already seen, so
+it does not forget them. The result is saved as the next version of the
+model, with metadata recording the models and sessions it came from. This
+file is run after recording new sessions.'''
+
+import os
+import re
+import keras
+import numpy as np
+
+from process import INPUTDIR, SCALES, RESOLUTION, make_dataset, make_stacks, read_manifest, load_dataset
+from registry import read_metadata, write_metadata
+from sampling import make_index
+from batches import split
+from train import train, VAL_SPLIT, AUGMENT, DEDUPE, BALANCE
+
+DATASET = 'datasets'
+BASE = 'models/modelA7' # The model to fine-tune. Its metadata has to record the sessions it was trained on
+
+EPOCHS = 5
+REPLAY_RATIO = 1.0 # Images sampled from the old sessions for every new image
+LEARNING_RATE = 0.0001 # Lower than the default, so the trained weights are only nudged
+SEED = 0
+
+
+def version_path(base):
+    '''Returns the path of the next version of a model, like models/modelA7-v2
+    for models/modelA7 or models/modelA7-v1, and models/modelA7-v3 for models/modelA7-v2'''
+
+    directory, name = os.path.split(base)
+    match = re.match(r'^(.*)-v(\d+)$', name)
+
+    root, version = (match.group(1), int(match.group(2))) if match else (name, 1)
+
+    while True:
+        version += 1
+        path = os.path.join(directory, root + '-v' + str(version))
+
+        if not os.path.exists(path):
+            return path
+
+def version(path):
+    '''Returns the version number in a model's path, which is 1 for a model
+    that has not been fine-tuned'''
+
+    match = re.match(r'^.*-v(\d+)$', os.path.basename(path))
+
+    return int(match.group(1)) if match else 1
+
+def session_rows(manifest, names):
+    '''Returns the dataset rows of the named sessions, in order'''
+
+    entries = [entry for entry in manifest['sessions'] if entry['name'] in names]
+
+    if not entries:
+        return np.empty(0, dtype = np.int64)
+
+    return np.concatenate([np.arange(entry['start'], entry['start'] + entry['count']) for entry in entries])
+
+def mix(new, old, ratio, random):
+    '''Returns the new training rows together with ratio times as many rows
+    sampled from the old ones, without replacement while there are enough'''
+
+    count = int(len(new) * ratio)
+    replay = random.choice(old, count, replace = count > len(old)) if len(old) else old
+
+    return np.sort(np.concatenate([new, replay])), replay
+
+def finetune(base, dataset = DATASET, epochs = EPOCHS, ratio = REPLAY_RATIO, learning_rate = LEARNING_RATE, seed = SEED):
+    '''Fine-tunes the model saved at base on the dataset's sessions it has not
+    been trained on, and saves it as the next version. Returns the new path,
+    or None if there were no new sessions'''
+
+    from keras.models import load_model
+
+    metadata = read_metadata(base)
+
+    if 'sessions' not in metadata:
+        raise ValueError(base + ' does not record the sessions it was trained on, so it cannot be fine-tuned')
+
+    make_dataset(INPUTDIR, dataset, SCALES)
+    index = make_index(dataset)
+
+    scale = metadata.get('scale', 4)
+    frames = metadata.get('frames', 1)
+
+    if frames > 1:
+        make_stacks(dataset, scale, frames)
+
+    manifest = read_manifest(dataset)
+    resample = manifest.get('resample', 'slice')
+
+    if resample != metadata.get('resample', resample):
+        raise ValueError(base + ' was trained on images shrunk with the ' + metadata['resample'] + ' method, not ' +
+                         resample)
+
+    seen = set(metadata['sessions'])
+    new_sessions = [entry['name'] for entry in manifest['sessions'] if entry['name'] not in seen]
+
+    if not new_sessions:
+        print('No sessions recorded since ' + base + ' was trained')
+        return None
+
+    images, labels, _ = load_dataset(dataset, scale, frames)
+
+    # The last fraction of the new rows is held out, like the last fraction of
+    # the old rows was, and the model is checked on both so forgetting shows up
+    new_rows = session_rows(manifest, new_sessions)
+    old_rows = session_rows(manifest, seen)
+
+    new_train, new_val = [new_rows[part] for part in split(len(new_rows), VAL_SPLIT)]
+    old_train, old_val = [old_rows[part] for part in split(len(old_rows), VAL_SPLIT)]
+
+    if DEDUPE == 'drop':
+        new_train = new_train[index['keep'][new_train]]
+        old_train = old_train[index['keep'][old_train]]
+
+    random = np.random.RandomState(seed)
+    train_rows, replay = mix(new_train, old_train, ratio, random)
+    val_rows = np.concatenate([old_val, new_val])
+
+    print('Fine-tuning ' + base + ' on ' + str(len(new_train)) + ' new images and ' + str(len(replay)) + ' old ones')
+
+    model = load_model(base)
+    output = version_path(base)
+
+    history = train(model, images, labels, output, epochs = epochs, augment = AUGMENT, seed = seed,
+                    weights = index['weights'] if DEDUPE == 'weight' else None, balance = BALANCE,
+                    indices = (train_rows, val_rows), optimizer = keras.optimizers.Adam(lr = learning_rate))
+
+    accuracy = history.history.get('val_acc', history.history.get('val_accuracy'))
+    size = int(RESOLUTION / scale)
+
+    lineage = metadata.get('lineage', []) + [os.path.basename(base)]
+
+    metadata.update({'input_shape': metadata.get('input_shape', [size, size, frames]),
+                     'samples': manifest['count'],
+                     'sessions': [entry['name'] for entry in manifest['sessions']],
+                     'val_acc': float(max(accuracy)),
+                     'parent': os.path.basename(base),
+                     'lineage': lineage,
+                     'version': version(output),
+                     'finetune': {'new_sessions': new_sessions,
+                                  'new_images': len(new_train),
+                                  'replayed_images': len(replay),
+                                  'epochs': epochs,
+                                  'replay_ratio': ratio,
+                                  'learning_rate': learning_rate}})
+
+    write_metadata(output, metadata)
+
+    try:
+        from engine import export
+
+        export(output, output + '.npz')
+    except ImportError:
+        print('h5py is not installed, so ' + output + ' was not exported for the numpy runner')
+
+    print('Saved ' + output + ', validation accuracy ' + str(metadata['val_acc']))
+
+    return output
+
+def main():
+    finetune(BASE)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+'''Defines the FrameHistory class, a preallocated ring buffer of the last few
+frames the car has seen, stacked as channels for the temporal models.'''
+
+import numpy as np
+
+
+class FrameHistory:
+    '''Keeps the last K frames in a buffer of 2K channels. Every frame is
+    written into two channels K apart, so the last K frames are always K
+    neighbouring channels of the buffer, oldest first. Reading them is a
+    view of the buffer, not a copy, and adding a frame never allocates.'''
+
+    def __init__(self, frames, shape, dtype = np.float32):
+        self.frames = frames
+        self.buffer = np.zeros(tuple(shape) + (2 * frames,), dtype = dtype)
+
+        self.index = 0 # Channel the next frame is written to
+        self.count = 0 # Frames pushed since the history was last reset
+
+    def push(self, frame):
+        '''Adds a frame as the newest, dropping the oldest. The first frame
+        after a reset fills the whole history, like the dataset builder pads
+        the start of a session'''
+
+        if self.count == 0:
+            self.buffer[...] = frame[..., np.newaxis]
+        else:
+            self.buffer[..., self.index] = frame
+            self.buffer[..., self.index + self.frames] = frame
+
+        self.index = (self.index + 1) % self.frames
+        self.count += 1
+
+    def replace(self, frame):
+        '''Overwrites the newest frame, without moving the older ones along'''
+
+        if self.count == 0:
+            return self.push(frame)
+
+        newest = (self.index - 1) % self.frames
+
+        self.buffer[..., newest] = frame
+        self.buffer[..., newest + self.frames] = frame
+
+    def view(self):
+        '''Returns the last K frames as a (..., K) view, oldest first'''
+
+        return self.buffer[..., self.index:self.index + self.frames]
+
+    def reset(self):
+        '''Forgets every frame, so the next frame fills the history again'''
+
+        self.count = 0
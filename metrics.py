@@ -0,0 +1,91 @@
+'''Defines the Metrics class, a small registry of timing histograms and
+counters for the control pipeline. Timings are kept in fixed-size ring
+buffers, so recording one costs a single array write, and the registry is
+rendered in the Prometheus text format for the remote's /metrics page.'''
+
+import numpy as np
+
+SIZE = 1024 # Number of recent observations each histogram keeps
+QUANTILES = [0.5, 0.95, 0.99]
+PREFIX = 'car'
+
+
+class Histogram:
+    '''Keeps the most recent observations in a preallocated ring buffer, and
+    computes quantiles over them only when they are asked for'''
+
+    def __init__(self, size = SIZE):
+        self.values = np.zeros(size)
+        self.count = 0 # Observations ever made, not just the ones still kept
+        self.total = 0.0
+
+    def observe(self, value):
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+        self.total += value
+
+    def quantiles(self, quantiles = QUANTILES):
+        '''Returns the quantiles of the observations still in the buffer'''
+
+        kept = min(self.count, len(self.values))
+
+        if kept == 0:
+            return [float('nan')] * len(quantiles)
+
+        return [float(value) for value in np.percentile(self.values[:kept], [q * 100 for q in quantiles])]
+
+class Metrics:
+    '''A registry of per-stage timing histograms and named counters. Counters
+    are functions that are only called when the metrics are rendered, so the
+    systems that own them do not pay anything to keep them up to date'''
+
+    def __init__(self, prefix = PREFIX):
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, stage, seconds):
+        '''Records how long a stage of the pipeline took'''
+
+        histogram = self.histograms.get(stage)
+
+        if histogram is None:
+            histogram = self.histograms.setdefault(stage, Histogram())
+
+        histogram.observe(seconds)
+
+    def counter(self, name, function):
+        '''Registers a function that returns the current value of a counter'''
+
+        self.counters[name] = function
+
+    def summary(self):
+        '''Returns the quantiles of every stage and the value of every counter'''
+
+        names = ['p%g' % (quantile * 100) for quantile in QUANTILES]
+
+        stages = {stage: dict(zip(names, histogram.quantiles())) for stage, histogram in list(self.histograms.items())}
+        counters = {name: function() for name, function in list(self.counters.items())}
+
+        return {'stages': stages, 'counters': counters}
+
+    def render(self):
+        '''Returns every metric in the Prometheus text exposition format'''
+
+        name = self.prefix + '_stage_seconds'
+        histograms = sorted(list(self.histograms.items())) # Copied first, as stages are added while rendering
+
+        lines = ['# TYPE ' + name + ' summary'] if histograms else []
+
+        for stage, histogram in histograms:
+            for quantile, value in zip(QUANTILES, histogram.quantiles()):
+                lines.append('%s{stage="%s",quantile="%s"} %.6f' % (name, stage, quantile, value))
+
+            lines.append('%s_sum{stage="%s"} %.6f' % (name, stage, histogram.total))
+            lines.append('%s_count{stage="%s"} %d' % (name, stage, histogram.count))
+
+        for counter, function in sorted(list(self.counters.items())):
+            lines.append('# TYPE %s_%s_total counter' % (self.prefix, counter))
+            lines.append('%s_%s_total %d' % (self.prefix, counter, function()))
+
+        return '\n'.join(lines) + '\n'
@@ -1,5 +1,7 @@
 '''Defines all the different models that were tested as candidates for
-the final self-driving model. Also reports validation accuracies achieved.'''
+the final self-driving model. Also reports validation accuracies achieved.
+Each model takes the shape of its input images, so it can be trained on
+any of the dataset's scales.'''
 
 import keras
 import numpy as np
@@ -10,11 +12,11 @@ from keras.layers import Conv2D, MaxPooling2D
 from keras.layers.advanced_activations import LeakyReLU
 
 # Consistently at about 0.80 validation accuracy
-def modelA():
+def modelA(input_shape = (16, 16, 1)):
     print('Now Loading Model A. Created 3/22')
 
     model = Sequential()
-    model.add(Conv2D(8, kernel_size=(3, 3), activation='linear',padding='same', input_shape = (16, 16, 1)))
+    model.add(Conv2D(8, kernel_size=(3, 3), activation='linear',padding='same', input_shape = input_shape))
     model.add(LeakyReLU(alpha=0.1))
     model.add(MaxPooling2D(pool_size=(2, 2), padding='same'))
     model.add(Dropout(0.25))
@@ -34,11 +36,11 @@ def modelA():
 
 # A wider version of model A
 # Similar performance to model A: validation accuracy of about 0.8
-def modelB():
+def modelB(input_shape = (16, 16, 1)):
     print('Now Loading Model B. Created 3/22')
 
     model = Sequential()
-    model.add(Conv2D(16, kernel_size=(3, 3), activation='linear',padding='same', input_shape=(16, 16, 1)))
+    model.add(Conv2D(16, kernel_size=(3, 3), activation='linear',padding='same', input_shape = input_shape))
     model.add(LeakyReLU(alpha=0.1))
     model.add(MaxPooling2D(pool_size=(2, 2), padding='same'))
     model.add(Dropout(0.25))
@@ -58,11 +60,11 @@ def modelB():
 
 # Identical to model A, but uses the 32x32 images
 # Also obtained a validation accuracy of 0.8
-def modelC():
+def modelC(input_shape = (32, 32, 1)):
     print('Now Loading Model C. Created 3/22')
 
     model = Sequential()
-    model.add(Conv2D(8, kernel_size=(3, 3), activation='linear',padding='same', input_shape=(32, 32, 1)))
+    model.add(Conv2D(8, kernel_size=(3, 3), activation='linear',padding='same', input_shape = input_shape))
     model.add(LeakyReLU(alpha=0.1))
     model.add(MaxPooling2D(pool_size=(2, 2), padding='same'))
     model.add(Dropout(0.25))
@@ -81,11 +83,11 @@ def modelC():
     return model
 
 # Identical to modelA, but without dropout. Also obtained 0.8 validation accuracy
-def modelD():
+def modelD(input_shape = (16, 16, 1)):
     print('Now Loading Model D. Created 3/25')
 
     model = Sequential()
-    model.add(Conv2D(8, kernel_size=(3, 3), activation='linear',padding='same', input_shape = (16, 16, 1)))
+    model.add(Conv2D(8, kernel_size=(3, 3), activation='linear',padding='same', input_shape = input_shape))
     model.add(LeakyReLU(alpha=0.1))
     model.add(MaxPooling2D(pool_size=(2, 2), padding='same'))
     model.add(Conv2D(16, kernel_size=(3, 3), activation='linear',padding='same'))
@@ -102,11 +104,11 @@ def modelD():
 
 # Identical to modelA, but with another convolutional layer
 # Does not improve upon the validation accuracy (still 0.8)
-def modelE():
+def modelE(input_shape = (16, 16, 1)):
     print('Now Loading Model E. Created 3/25')
 
     model = Sequential()
-    model.add(Conv2D(8, kernel_size=(3, 3), activation='linear',padding='same', input_shape = (16, 16, 1)))
+    model.add(Conv2D(8, kernel_size=(3, 3), activation='linear',padding='same', input_shape = input_shape))
     model.add(LeakyReLU(alpha=0.1))
     model.add(MaxPooling2D(pool_size=(2, 2), padding='same'))
     model.add(Dropout(0.25))
@@ -128,3 +130,28 @@ def modelE():
 
     return model
 
+
+# Model A for a stack of the last few frames, one per channel, so it can tell
+# which way the car is already turning. The extra filters in the first layer
+# give it room to compare the frames
+def modelF(input_shape = (16, 16, 4)):
+    print('Now Loading Model F. Temporal version of model A')
+
+    model = Sequential()
+    model.add(Conv2D(16, kernel_size=(3, 3), activation='linear',padding='same', input_shape = input_shape))
+    model.add(LeakyReLU(alpha=0.1))
+    model.add(MaxPooling2D(pool_size=(2, 2), padding='same'))
+    model.add(Dropout(0.25))
+    model.add(Conv2D(16, kernel_size=(3, 3), activation='linear',padding='same'))
+    model.add(LeakyReLU(alpha=0.1))
+    model.add(MaxPooling2D(pool_size=(2, 2), padding='same'))
+    model.add(Dropout(0.25))
+    model.add(Flatten())
+    model.add(Dense(16, activation='linear'))
+    model.add(LeakyReLU(alpha=0.1))
+    model.add(Dropout(0.25))
+    model.add(Dense(3, activation='softmax'))
+
+    model.summary()
+
+    return model
@@ -0,0 +1,163 @@
+'''Runs the car as three processes instead of threads in one interpreter, so
+that capturing, driving and serving the remote each get a core and a GIL of
+their own. The capture process writes camera frames into a FrameRing in
+shared memory. The control process reads them through a SharedCamera and
+runs the car, recorder and autodriver with a Controller, exactly as the
+single process remote does. The web process serves the remote, sending
+commands to the control process and receiving its status over queues.'''
+
+import queue
+import atexit
+import multiprocessing
+
+from time import time
+from functools import partial
+from threading import Thread
+
+from shared import FrameRing, SharedCamera
+from controller import COMMANDS, MODELDIR, BACKEND
+from registry import Registry
+from metrics import Metrics
+
+INTERVAL = 0.5 # Longest time, in seconds, between status updates from the control process
+
+
+def capture(ring, replay):
+    '''The capture process. Writes every frame from the camera, or from the
+    replayed recordings, into the ring'''
+
+    from sources import PiCameraSource, ReplaySource
+
+    source = ReplaySource(replay) if replay else PiCameraSource()
+
+    for plane in source.frames(ring.resolution, ring.framerate):
+        ring.write(plane, time())
+
+def control(ring, commands, statuses, replay, interval = INTERVAL):
+    '''The control process. Builds a Controller around the frames in the ring,
+    applies each command from the web process, and sends back the status and
+    the rendered metrics after every command, and every interval otherwise'''
+
+    from controller import Controller
+    from stub_gpio import StubGPIO
+
+    controller = Controller(SharedCamera(ring), gpio = StubGPIO() if replay else None)
+
+    while True:
+        try:
+            name, args = commands.get(timeout = interval)
+        except queue.Empty:
+            pass
+        else:
+            if name == 'model':
+                try:
+                    controller.select_model(*args)
+                except KeyError:
+                    print('Unknown model ' + str(args[0]))
+            elif name in controller.commands:
+                controller.commands[name]()
+            else:
+                print('Unknown command ' + str(name))
+
+        statuses.put((controller.status(), controller.render_metrics()))
+
+class Pipeline:
+    '''Starts the capture and control processes, and stands in for their
+    Controller in the web process. It has the same commands, status, models,
+    select_model and render_metrics as a Controller, so the remote's routes
+    work the same either way. The processes are forked before any thread is
+    started in the web process, and are stopped and the shared memory freed
+    when it exits.'''
+
+    def __init__(self, resolution, framerate, replay = None):
+        context = multiprocessing.get_context('fork')
+
+        self.ring = FrameRing(resolution, framerate, context = context)
+        self.queue = context.Queue() # Commands for the control process
+        self.statuses = context.Queue() # Status updates from the control process
+
+        self.processes = [context.Process(target = capture, args = (self.ring, replay), name = 'capture'),
+                          context.Process(target = control, args = (self.ring, self.queue, self.statuses, replay),
+                                          name = 'control')]
+
+        for process in self.processes:
+            process.daemon = True
+            process.start()
+
+        atexit.register(self.close)
+
+        self.camera = SharedCamera(self.ring)
+        self.metrics = Metrics() # Metrics of the web process itself
+        self.registry = Registry(MODELDIR, BACKEND) # Only used to list the models
+        self.changed = lambda: None
+
+        self.latest = {} # The newest status of the control process
+        self.rendered = '' # The newest metrics of the control process
+
+        self.commands = {name: partial(self.send, name) for name in COMMANDS}
+
+        thread = Thread(target = self.listen)
+        thread.daemon = True
+
+        thread.start()
+
+        print('Pipeline Active')
+
+    def send(self, name, *args):
+        '''Sends a command to the control process'''
+
+        self.queue.put((name, args))
+
+    def listen(self):
+        '''Receives the status of the control process, and tells the remote
+        whenever anything other than the metrics has changed'''
+
+        while True:
+            status, rendered = self.statuses.get()
+
+            changed = {key: value for key, value in status.items() if key != 'metrics'} != \
+                      {key: value for key, value in self.latest.items() if key != 'metrics'}
+
+            self.latest = status
+            self.rendered = rendered
+
+            if changed:
+                self.changed()
+
+    def status(self):
+        return self.latest
+
+    def models(self):
+        self.registry.active = self.latest.get('model')
+
+        return {'models': self.registry.index(),
+                'active': self.latest.get('model'),
+                'loading': self.latest.get('loading'),
+                'error': self.latest.get('model_error')}
+
+    def select_model(self, name):
+        if name not in self.registry.names():
+            raise KeyError(name)
+
+        if self.latest.get('loading') is not None:
+            return False
+
+        self.send('model', name)
+
+        return True
+
+    def render_metrics(self):
+        return self.rendered + self.metrics.render()
+
+    def close(self):
+        '''Stops the processes, and frees the shared memory. Does nothing if
+        they have already been stopped'''
+
+        if self.ring.memory is None:
+            return
+
+        for process in self.processes:
+            process.terminate()
+            process.join()
+
+        self.ring.close(unlink = True)
@@ -1,53 +1,143 @@
 '''Contains functions that process data prior to training and predicting.
-This file is run to make all the necessary datasets for training.'''
+This file is run to make all the necessary datasets for training.
+
+A dataset is a directory of memory-mapped .npy arrays: image64.npy holds every
+recorded uint8 image, the other image<size>.npy files hold copies shrunk by reduce_dim,
+and labels.npy and sessions.npy hold each image's label and session id. The
+manifest records which recorded sessions have already been ingested, so that
+re-running only adds sessions recorded since the last run. A session is only
+ingested once it has been closed, since its rows have to stay together. The arrays have
+room for more rows than the dataset has, and only the first manifest count
+rows of each are part of the dataset.'''
 
 import os
+import json
 import numpy as np
 
-from keras.utils import to_categorical
+from numpy.lib.format import open_memmap
+
+import session
+
+from resample import downscale
 
 INPUTDIR = 'images'
 OUTPUTDIR = 'datasets'
 SCALES = [1, 2, 4]
+RESOLUTION = 64 # Size of the images recorded by the car
+RESAMPLE = 'mean' # How images are shrunk, for both training and driving. See resample.py
+FRAMES = [4] # Numbers of frames stacked together for the temporal models
+STACK_SCALE = 4 # Scale the stacks of frames are made at
+CHUNK = 4096 # Rows of stacks built at a time
+HEADROOM = 1.5 # Arrays that run out of room are grown to this many times the rows they need
 
-def combine(directory):
-    '''Combines all the data from a directory into one big array'''
+MANIFEST = 'manifest.json'
 
-    final = None
+def image_path(outputdir, scale):
+    '''Returns the path of the image array for a scale'''
 
-    for filename in os.listdir(directory):
-        if filename.endswith('.npy'):
-            if final is None:
-                final = np.load(directory + '/' + filename)
-            else:
-                final = np.vstack((final, np.load(directory + '/' + filename)))
+    return os.path.join(outputdir, 'image' + str(int(RESOLUTION/scale)) + '.npy')
 
-    return final
+def stack_path(outputdir, scale, frames):
+    '''Returns the path of the array of stacked frames for a scale'''
 
-def get_images(dataset):
-    '''Returns all the images from a dataset'''
+    return os.path.join(outputdir, 'stack' + str(int(RESOLUTION/scale)) + 'x' + str(frames) + '.npy')
 
-    return np.array([image for image in dataset[:, 0]])
+def read_manifest(outputdir):
+    '''Returns the manifest of a dataset, or an empty one if there is no dataset yet'''
 
-def get_labels(dataset):
-    '''Returns all the labels from a dataset'''
+    path = os.path.join(outputdir, MANIFEST)
 
-    return dataset[:, 1]
+    if not os.path.exists(path):
+        return {'count': 0, 'sessions': [], 'resample': RESAMPLE}
 
-def reduce_dim(images, factor):
-    '''Converts images to lower quality by slicing out parts of the image.
-    Use a factor of 2 to got from 64x64 to 32x32'''
+    with open(path) as f:
+        return json.load(f)
 
-    return np.array([image[::factor, ::factor] for image in images])
+def write_manifest(outputdir, manifest):
+    '''Atomically replaces the manifest of a dataset'''
 
-def prep_images(images):
-    '''Reshapes an array of images, scales to between 0 and 1
-    Prepares the images for use with keras'''
+    path = os.path.join(outputdir, MANIFEST)
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent = 2)
+
+    os.replace(path + '.tmp', path)
+
+def list_sessions(inputdir):
+    '''Returns the names of all recorded sessions in a directory, in order'''
+
+    return [name for name in sorted(os.listdir(inputdir))
+            if name.endswith('.npy') or session.is_session(os.path.join(inputdir, name))]
+
+def grow(path, shape, dtype, count):
+    '''Creates a memory-mapped array at a temporary path with the given shape,
+    and copies the first count rows of the existing array at path into it'''
+
+    grown = open_memmap(path + '.tmp', mode = 'w+', dtype = dtype, shape = shape)
+
+    if count > 0:
+        grown[:count] = np.load(path, mmap_mode = 'r')[:count]
+
+    return grown
+
+def reserve(path, shape, dtype, count):
+    '''Returns a writable memory-mapped array at path with room for shape[0]
+    rows, whose first count rows are the dataset's. If the array already has
+    room, it is returned as it is, and the new rows are written into it in
+    place. Otherwise it is copied into an array with HEADROOM times the rows
+    needed, which is moved into place before any new row is written. Either
+    way the first count rows never change, so a crash leaves the dataset as
+    the manifest describes it, and adding a session only copies the whole
+    dataset when it runs out of room'''
+
+    if count > 0:
+        existing = np.load(path, mmap_mode = 'r+')
+
+        if len(existing) >= shape[0]:
+            return existing
+
+        del existing
+
+    grown = grow(path, (int(shape[0] * HEADROOM),) + tuple(shape[1:]), dtype, count)
+    grown.flush()
+    del grown
 
-    dim = images.shape[1]
+    os.replace(path + '.tmp', path)
 
-    images = images.reshape(-1, dim, dim, 1)
-    images = images/255
+    return np.load(path, mmap_mode = 'r+')
+
+def load_dataset(outputdir, scale = 1, frames = 1):
+    '''Returns memory-mapped (images, labels, sessions) arrays of a dataset at a
+    scale. With more than one frame, each image is a (H, W, frames) stack of the
+    image and the ones recorded before it. Rows past the manifest's count are
+    room for sessions that have not been added yet, and are left out'''
+
+    count = read_manifest(outputdir)['count']
+
+    if frames == 1:
+        images = np.load(image_path(outputdir, scale), mmap_mode = 'r')
+    else:
+        images = np.load(stack_path(outputdir, scale, frames), mmap_mode = 'r')
+
+    labels = np.load(os.path.join(outputdir, 'labels.npy'), mmap_mode = 'r')
+    sessions = np.load(os.path.join(outputdir, 'sessions.npy'), mmap_mode = 'r')
+
+    return images[:count], labels[:count], sessions[:count]
+
+def reduce_dim(images, factor, method = RESAMPLE):
+    '''Converts images to lower quality by averaging blocks of pixels, or with
+    the slice method, by slicing out parts of the image. Works on a whole
+    (N, H, W) batch at once. Use a factor of 2 to got from 64x64 to 32x32'''
+
+    return downscale(np.asarray(images), factor, method)
+
+def prep_images(images):
+    '''Reshapes an array of images, scales to between 0 and 1 as float32.
+    Images without channels are given one channel, and stacks of frames
+    keep a channel for each frame. Prepares the images for use with keras'''
+
+    images = images.reshape(images.shape[:3] + (-1,)).astype(np.float32)
+    images /= 255
 
     return images
 
@@ -55,28 +145,152 @@ def prep_labels(labels):
     '''Uses one-hot encoding to set up labels for training.
     This is the format that keras wants them in for training.'''
 
+    from keras.utils import to_categorical # Imported here so the car does not need keras to preprocess
+
     return to_categorical(labels)
 
+def session_starts(sessions):
+    '''Returns the first row of each row's session. The rows of a session are
+    always next to each other in a dataset'''
+
+    rows = np.arange(len(sessions))
+    boundaries = np.ones(len(sessions), dtype = bool)
+    boundaries[1:] = sessions[1:] != sessions[:-1]
+
+    return np.maximum.accumulate(np.where(boundaries, rows, 0))
+
+def stack_frames(images, starts, rows, frames):
+    '''Returns (len(rows), H, W, frames) stacks of each row's image and the
+    images recorded before it, oldest first. Stacks never reach back past the
+    start of the row's session; the session's first image is repeated instead'''
+
+    indices = rows[:, np.newaxis] - np.arange(frames - 1, -1, -1)[np.newaxis]
+    indices = np.maximum(indices, starts[rows][:, np.newaxis])
+
+    return images[indices].transpose(0, 2, 3, 1)
+
+def make_stacks(outputdir, scale, frames):
+    '''Builds the stacked frames of a dataset for the rows that do not have a
+    stack yet, a chunk of rows at a time. The stack array has room to spare
+    like the other arrays, so the manifest records how many of its rows
+    have been built'''
+
+    images, _, sessions = load_dataset(outputdir, scale)
+    path = stack_path(outputdir, scale, frames)
+    name = os.path.basename(path)
+
+    manifest = read_manifest(outputdir)
+    start = min(manifest.get('stacks', {}).get(name, 0), len(images)) if os.path.exists(path) else 0
+
+    if start == len(images):
+        return
+
+    starts = session_starts(np.asarray(sessions))
+    stacks = reserve(path, images.shape + (frames,), np.uint8, start)
+
+    for row in range(start, len(images), CHUNK):
+        rows = np.arange(row, min(row + CHUNK, len(images)))
+        stacks[rows[0]:rows[-1] + 1] = stack_frames(images, starts, rows, frames)
+
+    stacks.flush()
+    del stacks
+
+    manifest.setdefault('stacks', {})[name] = len(images)
+    write_manifest(outputdir, manifest)
+
+    print('Stacked ' + str(frames) + ' frames for ' + str(len(images) - start) + ' images')
+
 def make_dataset(inputdir, outputdir, scales):
-    '''Does all the steps at once. Combines the images from a directory,
-    seperates the data into images and labels, creates different resolution
-    copy of the images, and then saves the images and labels.'''
+    '''Does all the steps at once. Finds the closed sessions that are not in the
+    dataset yet, grows the dataset arrays to fit them, copies their images
+    and labels in, creates the different resolution copies of the new images,
+    and then records the sessions in the manifest. Every image in a dataset
+    has to be shrunk the same way, so the method is recorded too.'''
+
+    os.makedirs(outputdir, exist_ok = True)
+
+    manifest = read_manifest(outputdir)
+
+    # Datasets made before the resampling method was recorded were sliced
+    if manifest['count'] > 0 and manifest.get('resample', 'slice') != RESAMPLE:
+        raise ValueError('The dataset in ' + outputdir + ' was shrunk with the ' + manifest.get('resample', 'slice') +
+                         ' method, not ' + RESAMPLE + '. Delete it to rebuild it from scratch')
+
+    manifest['resample'] = RESAMPLE
+
+    known = set(entry['name'] for entry in manifest['sessions'])
+    new = []
+
+    for name in list_sessions(inputdir):
+        if name in known:
+            continue
 
-    combined = combine(inputdir)
+        if session.is_complete(os.path.join(inputdir, name)):
+            new.append(name)
+        else:
+            print('Skipped ' + name + ', which is still being recorded or was never closed. Add an empty ' +
+                  session.COMPLETE + ' file to it to add it as it is')
 
-    images = get_images(combined)
-    labels = get_labels(combined)
+    if len(new) == 0:
+        print('No new sessions, dataset has ' + str(manifest['count']) + ' images')
+        return
+
+    lengths = [session.session_length(os.path.join(inputdir, name)) for name in new]
+
+    start = manifest['count']
+    total = start + sum(lengths)
+
+    scales = sorted(set(scales) | {1}) # The full resolution images are always kept
+    arrays = {}
 
     for scale in scales:
-        image_data = reduce_dim(images, scale)
-        print(image_data.shape)
-        np.save(outputdir + '/image' + str(int(64/scale)), image_data)
+        size = int(RESOLUTION/scale)
+        arrays[image_path(outputdir, scale)] = reserve(image_path(outputdir, scale), (total, size, size), np.uint8, start)
+
+    labels_path = os.path.join(outputdir, 'labels.npy')
+    sessions_path = os.path.join(outputdir, 'sessions.npy')
+
+    arrays[labels_path] = reserve(labels_path, (total,), np.int8, start)
+    arrays[sessions_path] = reserve(sessions_path, (total,), np.int32, start)
+
+    session_id = len(manifest['sessions'])
+    row = start
+
+    for name, length in zip(new, lengths):
+        if length == 0:
+            continue # Left out of the manifest, so it is picked up once it has data
+
+        images, labels, _ = session.load(os.path.join(inputdir, name))
 
-    np.save(outputdir + '/labels', labels)
-    print(labels.shape)
+        for scale in scales:
+            arrays[image_path(outputdir, scale)][row:row + length] = reduce_dim(images, scale)
+
+        arrays[labels_path][row:row + length] = labels
+        arrays[sessions_path][row:row + length] = session_id
+
+        manifest['sessions'].append({'name': name, 'id': session_id, 'start': row, 'count': length})
+        print('Added ' + name + ': ' + str(length) + ' images')
+
+        session_id += 1
+        row += length
+
+    for array in arrays.values():
+        array.flush()
+
+    arrays.clear() # Closes the memory maps
+
+    # Only the manifest makes the new rows part of the dataset, so a crash
+    # before it is written leaves the dataset as it was
+    manifest['count'] = total
+    write_manifest(outputdir, manifest)
+
+    print('Dataset has ' + str(total) + ' images')
 
 def main():
     make_dataset(INPUTDIR, OUTPUTDIR, SCALES)
 
+    for frames in FRAMES:
+        make_stacks(OUTPUTDIR, STACK_SCALE, frames)
+
 if __name__ == '__main__':
     main()
@@ -1,12 +1,14 @@
 '''Defines the Recorder class, which is responsible for recording the training
 data while the car is in recording mode. Runs in a background thread.'''
 
-import numpy as np
+import os
 
 from time import sleep
 from threading import Thread
 from datetime import datetime
 
+from session import SessionWriter
+
 
 class Recorder:
     '''Responsible for capturing the images the car sees as it is being driven.
@@ -22,7 +24,7 @@ class Recorder:
         self.interval = interval
         self.recording = False
 
-        self.save_queue = [] # Saved to a file after recording stopped
+        self.writer = None # Streams the current session to disk while recording
 
         thread = Thread(target = self.run)
         thread.daemon = True # stops the thread after the main program stops
@@ -34,21 +36,24 @@ class Recorder:
     def run(self):
         '''The primary background thread for the recorder, which is always running.
         When recording mdoe is on, the recorder will pair the image from the camera
-        with the label from the car's steering status, and append it to an array.
-        When recording mode is toggled, the array of images will be saved'''
+        with the label from the car's steering status, and stream it to the session
+        on disk. When recording mode is toggled off, the session will be closed'''
 
         while True:
             drive_status, steer_status = self.car.get_status()
 
+            if self.recording and self.writer is None:
+                self.start()
+
             if drive_status == 'forward' and self.recording:
-                image = self.camera.array()
+                frame = self.camera.wait_frame()
                 label = self.label_to_number(steer_status)
 
-                self.save_queue.append((image, label))
+                self.writer.add(frame.luma, label, frame.timestamp)
 
                 print('Snapped a picture')
 
-            elif not self.recording and len(self.save_queue) != 0:
+            elif not self.recording and self.writer is not None:
                 self.save()
 
             sleep(self.interval)
@@ -69,15 +74,23 @@ class Recorder:
         else:
             return 2
 
+    def start(self):
+        '''Starts a new session, named with the timestamp, that images are written to.'''
+
+        self.writer = SessionWriter(os.path.join('images', self.timestamp()))
+
     def save(self):
-        '''Saves the current queue of images as the timestamp, then clears the queue.'''
+        '''Writes the rest of the current session in the background, then
+        closes it so the next recording starts a new session.'''
 
-        timestamp = self.timestamp()
+        self.writer.close()
 
-        np.save('images/' + timestamp, self.save_queue)
-        print('Saved images as ' + timestamp + ".npy")
+        if self.writer.chunks:
+            print('Saved images as ' + self.writer.directory)
+        else:
+            print('Nothing was recorded, so no session was saved')
 
-        self.save_queue = []
+        self.writer = None
 
     def timestamp(self):
         '''Simple function that defines what part of the timestamp are used
@@ -0,0 +1,164 @@
+'''Defines the Registry class, which keeps track of the saved models the car
+can drive with, and loads a new one in the background so the remote can
+switch models without restarting. Each model can have a metadata file next
+to it, like models/modelA7.json, written by train.py. This file is run to
+list the models.'''
+
+import os
+import json
+import numpy as np
+
+from time import perf_counter
+from functools import partial
+from threading import Thread, Lock
+
+from runners import load
+
+MODELDIR = 'models'
+BACKEND = 'numpy'
+WARMUP = 20 # Predictions made on a new model before it drives, so the first real one is not slow
+
+EXTENSIONS = {'keras': ['', '.h5'], 'tflite': ['.tflite'], 'numpy': ['.npz']}
+METADATA = '.json'
+
+
+def write_metadata(path, metadata):
+    '''Atomically writes the metadata of the model saved at path'''
+
+    with open(path + METADATA + '.tmp', 'w') as f:
+        json.dump(metadata, f, indent = 2)
+
+    os.replace(path + METADATA + '.tmp', path + METADATA)
+
+def read_metadata(path):
+    '''Returns the metadata of the model saved at path, or an empty dict if it
+    was saved before models had metadata'''
+
+    if not os.path.exists(path + METADATA):
+        return {}
+
+    with open(path + METADATA) as f:
+        return json.load(f)
+
+def warm_up(runner, times = WARMUP):
+    '''Runs a model on blank images, and returns the median time it took'''
+
+    images = np.zeros((1,) + tuple(runner.input_shape), dtype = np.float32)
+    durations = []
+
+    for _ in range(times):
+        start = perf_counter()
+        runner.predict(images)
+        durations.append(perf_counter() - start)
+
+    return float(np.median(durations))
+
+class Registry:
+    '''Indexes the models in a directory that a backend can run, and loads
+    the model selected on the remote on a background thread. Once it is
+    loaded and warmed up, it is handed to a swap function, such as the
+    AutoDriver's set_model, and only one model is loaded at a time.'''
+
+    def __init__(self, directory = MODELDIR, backend = BACKEND, warmup = WARMUP):
+        self.directory = directory
+        self.backend = backend
+        self.warmup = warmup
+
+        self.active = None # Name of the model driving the car
+        self.loading = None # Name of the model being loaded
+        self.error = None # Why the last model failed to load
+
+        self.lock = Lock()
+
+    def names(self):
+        '''Returns the names of the models the backend can run, in order, or
+        none if the directory does not exist'''
+
+        names = []
+
+        try:
+            filenames = sorted(os.listdir(self.directory))
+        except FileNotFoundError:
+            return names
+
+        for filename in filenames:
+            if not os.path.isfile(os.path.join(self.directory, filename)):
+                continue
+
+            name, extension = os.path.splitext(filename)
+
+            if extension in EXTENSIONS[self.backend]:
+                names.append(filename if self.backend == 'keras' else name)
+
+        return names
+
+    def path(self, name):
+        '''Returns the path a model is loaded from, without the backend's extension'''
+
+        return os.path.join(self.directory, name)
+
+    def index(self):
+        '''Returns each model's name and metadata, and whether it is driving'''
+
+        return [dict(read_metadata(self.path(name)), name = name, active = name == self.active)
+                for name in self.names()]
+
+    def load(self, name):
+        '''Loads and warms up a model. Returns its runner and metadata'''
+
+        start = perf_counter()
+
+        runner = load(self.path(name), self.backend)
+        latency = warm_up(runner, self.warmup)
+
+        print('Loaded {} in {:.2f} s, {:.3f} ms a prediction'.format(name, perf_counter() - start, latency * 1000))
+
+        return runner, read_metadata(self.path(name))
+
+    def select(self, name, swap):
+        '''Starts loading a model in the background, to be handed to the swap
+        function with its metadata once it is ready, along with a function to
+        call once it is driving. Returns False if another model is still loading'''
+
+        if name not in self.names():
+            raise KeyError(name)
+
+        with self.lock:
+            if self.loading is not None:
+                return False
+
+            self.loading = name
+
+        thread = Thread(target = self.run, args = (name, swap))
+        thread.daemon = True
+
+        thread.start()
+
+        return True
+
+    def activate(self, name):
+        '''Records that a model is driving the car, once it has been swapped in'''
+
+        self.active = name
+
+    def run(self, name, swap):
+        '''Loads a model and swaps it in, on the background thread'''
+
+        try:
+            runner, metadata = self.load(name)
+            swap(runner, metadata, partial(self.activate, name))
+
+            self.error = None
+        except Exception as e:
+            self.error = name + ': ' + str(e)
+            print('Could not load ' + self.error)
+        finally:
+            with self.lock:
+                self.loading = None
+
+def main():
+    for entry in Registry().index():
+        print(json.dumps(entry))
+
+if __name__ == '__main__':
+    main()
@@ -1,40 +1,57 @@
 '''Web server that is central to running and training the autonomous car.
 Implements the remote control for controlling the car, handles requests
 for images on the remote, and allows both recording and auto mode to be
-toggled.'''
+toggled. Only what manual driving and the video need is loaded before
+the server starts; the model is loaded in the background.'''
 
-from flask import Flask, render_template, Response
+from time import perf_counter
+
+STARTED = perf_counter()
+
+import os
+
+from flask import Flask, render_template, Response, request, jsonify
 from time import sleep
-from keras.models import load_model
 
-from car import Car, PWMCar
 from camera import Camera
-from recorder import Recorder
-from autodriver import AutoDriver
+from sources import ReplaySource
+from stub_gpio import StubGPIO
+from control import ControlChannel
+from controller import Controller
 
-# Defines the web app, car, camera, recorder, model, and autodriver
+startup = {'imports': perf_counter() - STARTED} # Seconds each phase of starting up took
 
-app = Flask(__name__)
+# Setting REPLAY to a directory of recorded images runs the server off the car,
+# replaying those images instead of using the camera, and stubbing out the GPIO
+REPLAY = os.environ.get('REPLAY')
 
-car = PWMCar(forward = 18, backward = 23, right = 14, left = 15, speed = 0.8)
+# Setting PIPELINE runs the camera and the driving in processes of their own,
+# instead of threads next to the web server. See pipeline.py
+PIPELINE = os.environ.get('PIPELINE')
 
-camera = Camera(resolution = 64, framerate = 30)
+# Defines the web app, camera, and the controller of the car, recorder, models, and autodriver
 
-recorder = Recorder(car = car, camera = camera, interval = 0.05)
+app = Flask(__name__)
 
-model = load_model('models/modelA6')
+if PIPELINE:
+    from pipeline import Pipeline
 
-model._make_predict_function() # Necessary for model to run
+    controller = Pipeline(resolution = 64, framerate = 30, replay = REPLAY)
+    camera = controller.camera
+elif REPLAY:
+    camera = Camera(resolution = 64, framerate = 30, source = ReplaySource(REPLAY))
+    controller = Controller(camera, gpio = StubGPIO())
+else:
+    camera = Camera(resolution = 64, framerate = 30)
+    controller = Controller(camera)
 
-autodriver = AutoDriver(car = car, camera = camera, interval = 0.00, model = model)
+startup['ready'] = perf_counter() - STARTED # Time until the remote can drive the car by hand
 
-# Shortcuts to convert the command path to the function
-commands = {'left': car.left,
-            'right': car.right,
-            'forward': car.forward,
-            'backward': car.backward,
-            'stop': car.stop,
-            'straight': car.straight}
+commands = controller.commands
+
+channel = ControlChannel(commands, controller.status)
+controller.changed = channel.changed
+controller.metrics.counter('control_dropped', lambda: channel.dropped)
 
 @app.route('/')
 def index():
@@ -52,12 +69,20 @@ def image():
 
     return resp
 
+@app.route('/stream')
+def stream():
+    '''Streams the camera to the remote over one long-lived connection, as
+    a multipart jpeg that the browser replaces in place on every frame.'''
+
+    return Response(camera.stream(), mimetype = 'multipart/x-mixed-replace; boundary=frame')
+
 @app.route('/record')
 def record():
     '''Toggles recording mode for the recorder.'''
 
     print('Recording was toggled')
-    recorder.toggle_record()
+    commands['record']()
+    channel.changed()
     return ('', 204)
 
 @app.route('/auto')
@@ -65,15 +90,89 @@ def auto():
     '''Toggles autonomous mode for the car.'''
 
     print('Automatic mode was toggled')
-    autodriver.toggle_auto()
+    commands['auto']()
+    channel.changed()
     return ('', 204)
 
+@app.route('/metrics')
+def report_metrics():
+    '''Reports the timing of each stage of the control pipeline, and the
+    number of frames dropped, in the Prometheus text format.'''
+
+    return Response(controller.render_metrics(), mimetype = 'text/plain; version=0.0.4')
+
+@app.route('/models')
+def models():
+    '''Lists the models the car can drive with, and their metadata.'''
+
+    return jsonify(**controller.models())
+
+@app.route('/models/<name>', methods = ['POST'])
+def select_model(name):
+    '''Loads a model in the background, and swaps it in for the one driving
+    the car once it is warmed up. The car keeps driving with the old model
+    until then.'''
+
+    try:
+        started = controller.select_model(name)
+    except KeyError:
+        return ('Unknown model ' + name, 404)
+
+    if not started:
+        return ('Still loading another model', 409)
+
+    channel.changed()
+    return ('', 202)
+
+@app.route('/startup')
+def report_startup():
+    '''Reports how long each phase of starting up took, in seconds. The model
+    phase only appears once the model has loaded.'''
+
+    return jsonify(dict(startup, **controller.status().get('startup', {})))
+
 @app.route('/drive/<cmd>')
 def cmd(cmd):
     '''Handles requests from the buttons to move the car correctly.'''
 
     commands[cmd]()
+    channel.changed()
+    return ('', 204)
+
+@app.route('/control', methods = ['POST'])
+def control():
+    '''Receives a numbered command from the remote. Commands that arrive after
+    a newer command from the same remote are dropped. The body has to be a JSON
+    object with a string client, an integer seq and a known cmd.'''
+
+    data = request.get_json(force = True, silent = True)
+
+    if not isinstance(data, dict) or not all(key in data for key in ('client', 'seq', 'cmd')):
+        return ('Expected a JSON object with client, seq and cmd', 400)
+
+    if not isinstance(data['client'], str) or not isinstance(data['cmd'], str):
+        return ('client and cmd have to be strings', 400)
+
+    if not isinstance(data['seq'], int) or isinstance(data['seq'], bool):
+        return ('seq has to be an integer', 400)
+
+    if data['cmd'] not in commands:
+        return ('Unknown command ' + data['cmd'], 400)
+
+    channel.submit(data['client'], data['seq'], data['cmd'])
     return ('', 204)
 
+@app.route('/events')
+def events():
+    '''Streams the car's status to the remote as server-sent events.'''
+
+    resp = Response(channel.events(), mimetype = 'text/event-stream')
+
+    resp.headers['Cache-Control'] = 'no-cache'
+
+    return resp
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', debug = False)
+    print('Serving after {:.2f} s: {}'.format(startup['ready'], ', '.join('%s %.2f s' % item for item in startup.items())))
+
+    app.run(host='0.0.0.0', debug = False, threaded = True)
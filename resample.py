@@ -0,0 +1,111 @@
+'''Contains the functions that shrink images to the resolutions the models
+are trained on. They work on a single (H, W) frame or a whole (N, H, W)
+batch with the same code, so the car and the dataset builder shrink images
+in exactly the same way. This file is run to benchmark the methods.'''
+
+import numpy as np
+
+from time import perf_counter
+
+METHODS = ['mean', 'slice']
+DATASET = 'datasets'
+SAMPLES = 2000 # Images used by the benchmark
+
+
+def downscale(images, factor, method = 'mean', integer = True):
+    '''Shrinks the last two axes of images by a whole factor. The mean method
+    averages each factor x factor block of pixels, so every pixel contributes
+    and fine patterns do not alias. The slice method keeps only the top-left
+    pixel of each block, like the original reduce_dim. The integer mean
+    rounds to uint8 using integer arithmetic only'''
+
+    if factor == 1:
+        return images
+
+    if method == 'slice':
+        return images[..., ::factor, ::factor]
+
+    if method != 'mean':
+        raise ValueError('Unknown resampling method ' + method)
+
+    h, w = images.shape[-2] // factor, images.shape[-1] // factor
+    area = factor * factor
+
+    if integer:
+        dtype = np.uint16 if area * 255 < 2 ** 16 else np.uint32
+    else:
+        dtype = np.float32
+
+    trimmed = images[..., :h * factor, :w * factor]
+
+    # Adding up the strided views of each position in a block is much faster
+    # in numpy than reshaping into blocks and summing over two axes
+    total = trimmed[..., 0::factor, 0::factor].astype(dtype)
+
+    for i in range(factor):
+        for j in range(factor):
+            if i or j:
+                total += trimmed[..., i::factor, j::factor]
+
+    if not integer:
+        total /= area
+        return total
+
+    total += area // 2 # Rounds to the nearest value instead of down
+    total //= area
+
+    return total.astype(np.uint8)
+
+def upscale(images, factor):
+    '''Blows images back up by repeating pixels, to compare with the original'''
+
+    return images.repeat(factor, axis = -2).repeat(factor, axis = -1)
+
+def benchmark(images, factors = (2, 4), repeats = 5):
+    '''Times each method on a batch of (N, H, W) uint8 images, and measures how
+    far each shrunk image is from the original once blown back up, as the
+    root mean square error in pixel values. The loop method is the original
+    per-image list comprehension, for comparison'''
+
+    results = []
+
+    for factor in factors:
+        methods = {'loop': lambda: np.array([image[::factor, ::factor] for image in images]),
+                   'slice': lambda: np.ascontiguousarray(downscale(images, factor, 'slice')),
+                   'mean': lambda: downscale(images, factor, 'mean'),
+                   'mean-float': lambda: downscale(images, factor, 'mean', integer = False)}
+
+        size = images.shape[-1] // factor * factor
+
+        for name, function in methods.items():
+            times = []
+
+            for _ in range(repeats):
+                start = perf_counter()
+                small = function()
+                times.append(perf_counter() - start)
+
+            error = upscale(small.astype(np.float32), factor) - images[:, :size, :size]
+
+            results.append({'factor': factor,
+                            'method': name,
+                            'images_per_second': len(images) / min(times),
+                            'rmse': float(np.sqrt(np.mean(error ** 2)))})
+
+    return results
+
+def main():
+    from process import load_dataset
+
+    try:
+        images, _, _ = load_dataset(DATASET)
+        images = np.array(images[:SAMPLES])
+    except FileNotFoundError:
+        print('No dataset found, benchmarking random images')
+        images = np.random.randint(0, 256, (SAMPLES, 64, 64)).astype(np.uint8)
+
+    for result in benchmark(images):
+        print('x{factor} {method:10} {images_per_second:12.0f} images/s  rmse {rmse:.2f}'.format(**result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+'''Defines the inference runners the AutoDriver can use to run a model. Every
+runner has the same predict method as a keras model, so they can be swapped
+freely. The keras runner is kept as the reference the others are checked
+against. This file is run to export a model to TFLite and numpy, and to
+compare the outputs and latency of every runner.'''
+
+import sys
+import numpy as np
+
+from time import perf_counter
+
+MODELPATH = 'models/modelA6'
+DATASET = 'datasets'
+SCALE = 4 # The scale of the images the model was trained on
+SAMPLES = 500 # Number of images used to compare the runners
+
+# The (agreement, max error) each runner needs against the keras reference:
+# the share of decisions it has to agree on, and the largest difference in
+# probabilities it may have. The numpy engine does the same float arithmetic,
+# while the int8 TFLite model is only close, and may flip near ties
+TOLERANCES = {'numpy': (1.0, 1e-4), 'tflite': (0.97, 0.1)}
+
+BACKENDS = ['keras', 'tflite', 'numpy']
+
+
+class Runner:
+    '''Base class for inference runners. Subclasses load a model and set
+    input_shape to the (height, width, channels) shape of one input image'''
+
+    input_shape = None
+
+    def predict(self, images):
+        '''Returns the class probabilities for a batch of prepared images'''
+
+        raise NotImplementedError
+
+    def close(self):
+        '''Releases any resources held by the runner'''
+
+        pass
+
+class KerasRunner(Runner):
+    '''Runs a saved keras model with keras itself. With tensorflow 1, every
+    runner has a graph and session of its own, so closing a runner frees all
+    of its model's memory without touching the other models'''
+
+    def __init__(self, path):
+        import tensorflow as tf
+        from keras.models import load_model
+
+        if hasattr(tf, 'Session'):
+            self.graph = tf.Graph()
+            self.session = tf.Session(graph = self.graph)
+        else:
+            self.graph = self.session = None
+
+        with self.scope():
+            self.model = load_model(path)
+            self.model._make_predict_function() # Necessary for model to run on other threads
+
+        self.input_shape = tuple(self.model.input_shape[1:])
+
+    def scope(self):
+        '''Returns a context that makes the runner's graph and session the default'''
+
+        from contextlib import ExitStack
+
+        stack = ExitStack()
+
+        if self.session is not None:
+            stack.enter_context(self.graph.as_default())
+            stack.enter_context(self.session.as_default())
+
+        return stack
+
+    def predict(self, images):
+        with self.scope():
+            return self.model.predict(images)
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+        self.model = None
+
+class TFLiteRunner(Runner):
+    '''Runs a model exported by export_tflite with the TFLite interpreter. The
+    lightweight tflite_runtime package is used if it is installed'''
+
+    def __init__(self, path):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+
+        self.interpreter = Interpreter(model_path = path)
+        self.interpreter.allocate_tensors()
+
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+
+        self.input_shape = tuple(self.input['shape'][1:])
+
+    def predict(self, images):
+        '''The interpreter runs one image at a time, so batches are looped over'''
+
+        images = np.asarray(images, dtype = np.float32)
+        results = np.empty((len(images), self.output['shape'][-1]), dtype = np.float32)
+
+        for i in range(len(images)):
+            self.interpreter.set_tensor(self.input['index'], images[i:i + 1])
+            self.interpreter.invoke()
+
+            results[i] = self.interpreter.get_tensor(self.output['index'])[0]
+
+        return results
+
+def export_tflite(path, output, samples):
+    '''Converts a saved keras model to TFLite with int8 weights and activations.
+    The samples are prepared images used to calibrate the activation ranges.
+    Dropout layers are removed by the conversion.'''
+
+    import tensorflow as tf
+
+    def representative():
+        for image in samples:
+            yield [image[np.newaxis].astype(np.float32)]
+
+    if hasattr(tf.lite.TFLiteConverter, 'from_keras_model_file'):
+        converter = tf.lite.TFLiteConverter.from_keras_model_file(path)
+    else:
+        converter = tf.lite.TFLiteConverter.from_keras_model(tf.keras.models.load_model(path))
+
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative
+
+    with open(output, 'wb') as f:
+        f.write(converter.convert())
+
+def load(path, backend):
+    '''Returns a runner for the model saved at path. Exported copies of a model
+    are stored next to it, like models/modelA6.tflite'''
+
+    if backend == 'keras':
+        return KerasRunner(path)
+    if backend == 'tflite':
+        return TFLiteRunner(path + '.tflite')
+    if backend == 'numpy':
+        from engine import Engine
+
+        return Engine.load(path + '.npz')
+
+    raise ValueError('Unknown backend ' + backend)
+
+def latency(runner, images):
+    '''Returns the median time, in seconds, to predict a batch of one image'''
+
+    times = []
+
+    for i in range(len(images)):
+        start = perf_counter()
+        runner.predict(images[i:i + 1])
+        times.append(perf_counter() - start)
+
+    return float(np.median(times))
+
+def compare(reference, runners, images):
+    '''Checks each runner against the reference runner. Reports how often the
+    chosen direction agrees, the largest difference in probabilities, and the
+    median latency of a single decision'''
+
+    expected = reference.predict(images)
+    results = {}
+
+    for name, runner in runners.items():
+        predicted = runner.predict(images)
+
+        results[name] = {'agreement': float(np.mean(np.argmax(predicted, axis = 1) == np.argmax(expected, axis = 1))),
+                         'max_error': float(np.max(np.abs(predicted - expected))),
+                         'latency': latency(runner, images)}
+
+    return results
+
+def main():
+    from process import load_dataset, prep_images
+    from engine import export
+
+    images, _, _ = load_dataset(DATASET, SCALE)
+    rows = np.random.choice(len(images), min(SAMPLES, len(images)), replace = False)
+    samples = prep_images(images[np.sort(rows)])
+
+    export_tflite(MODELPATH, MODELPATH + '.tflite', samples)
+    export(MODELPATH, MODELPATH + '.npz')
+
+    reference = load(MODELPATH, 'keras')
+    runners = {backend: load(MODELPATH, backend) for backend in BACKENDS if backend != 'keras'}
+
+    print('{:8} latency {:.3f} ms'.format('keras', latency(reference, samples) * 1000))
+
+    failures = []
+
+    for name, result in compare(reference, runners, samples).items():
+        agreement, max_error = TOLERANCES[name]
+        failed = result['agreement'] < agreement or result['max_error'] >= max_error
+
+        if failed:
+            failures.append(name)
+
+        print('{:8} agreement {:.4f}  max error {:.5f}  latency {:.3f} ms {}'.format(
+            name, result['agreement'], result['max_error'], result['latency'] * 1000, 'MISMATCH' if failed else ''))
+
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+'''Contains the functions that index a dataset for sampling: a perceptual hash
+of every image, which images are near-duplicates of the one before them in
+their session, and the rows of each class. The index is stored next to the
+dataset in index.npz, and like the dataset it only grows by the sessions
+added since it was last built. This file is run to build the index.'''
+
+import os
+import numpy as np
+
+from process import OUTPUTDIR, load_dataset, session_starts
+from resample import downscale
+
+INDEX = 'index.npz'
+HASH_SIZE = 8 # Images are hashed at 8x8, into 64 bits
+DISTANCE = 4 # Hashes at most this many bits apart are near-duplicates
+CHUNK = 8192 # Images hashed at a time
+CLASSES = 3
+
+BITS = np.array([bin(i).count('1') for i in range(256)], dtype = np.uint8) # Set bits in each byte
+
+
+def hash_images(images):
+    '''Returns the 64 bit average hash of each of a batch of (N, H, W) images.
+    Each image is shrunk to 8x8, and each bit is whether a pixel is brighter
+    than the image's mean, so small changes in noise or exposure keep the hash'''
+
+    small = downscale(images, images.shape[-1] // HASH_SIZE, 'mean', integer = False)
+    small = small.reshape(len(images), -1)
+    bits = small > small.mean(axis = 1, keepdims = True)
+
+    return np.packbits(bits, axis = 1).view('>u8')[:, 0].astype(np.uint64)
+
+def distances(a, b):
+    '''Returns the number of bits that differ between each pair of hashes'''
+
+    return BITS[(np.asarray(a, dtype = np.uint64) ^ np.asarray(b, dtype = np.uint64)).view(np.uint8)] \
+        .reshape(-1, 8).sum(axis = 1)
+
+def near_duplicates(hashes, labels, sessions, distance = DISTANCE):
+    '''Walks each session in order and marks the images that are within the
+    distance of the last image kept, with the same label. A car sitting at a
+    wall or crawling along keeps its first image and drops the rest, however
+    long it stays. Returns whether each image is kept, and a weight for each
+    image that shares one unit of weight between a kept image and its
+    duplicates, for training on every image without the repeats counting more'''
+
+    keep = np.ones(len(hashes), dtype = bool)
+    starts = session_starts(np.asarray(sessions))
+
+    # Only images close to the one before them can be near-duplicates of the
+    # last kept image, so the walk only has to look at those
+    close = np.zeros(len(hashes), dtype = bool)
+    close[1:] = (distances(hashes[1:], hashes[:-1]) <= distance) & (labels[1:] == labels[:-1])
+    close[starts == np.arange(len(hashes))] = False
+
+    hashes = [int(value) for value in hashes]
+    kept = 0
+
+    for row in range(len(hashes)):
+        if close[row] and bin(hashes[row] ^ hashes[kept]).count('1') <= distance:
+            keep[row] = False
+        else:
+            kept = row
+
+    groups = np.cumsum(keep) - 1
+    weights = (1 / np.bincount(groups))[groups].astype(np.float32)
+
+    return keep, weights
+
+def class_indices(labels, rows, classes = CLASSES):
+    '''Returns the rows of each class, in order'''
+
+    labels = np.asarray(labels)[rows]
+
+    return [rows[labels == label] for label in range(classes)]
+
+def read_index(outputdir):
+    '''Returns the index of a dataset as a dict of arrays, or None if it has not been built'''
+
+    path = os.path.join(outputdir, INDEX)
+
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as index:
+        return {name: index[name] for name in index.files}
+
+def make_index(outputdir, distance = DISTANCE):
+    '''Hashes the images added to a dataset since the index was last built,
+    finds their near-duplicates, and atomically replaces the index. Sessions
+    are added to a dataset whole, so a new session never continues an old one'''
+
+    images, labels, sessions = load_dataset(outputdir)
+    index = read_index(outputdir)
+
+    start = len(index['hashes']) if index is not None else 0
+
+    if start == len(images):
+        print('Index is up to date, ' + str(start) + ' images')
+        return index
+
+    hashes = np.empty(len(images) - start, dtype = np.uint64)
+
+    for row in range(start, len(images), CHUNK):
+        end = min(row + CHUNK, len(images))
+        hashes[row - start:end - start] = hash_images(np.asarray(images[row:end]))
+
+    keep, weights = near_duplicates(hashes, np.asarray(labels[start:]), np.asarray(sessions[start:]), distance)
+
+    if index is not None:
+        hashes = np.concatenate([index['hashes'], hashes])
+        keep = np.concatenate([index['keep'], keep])
+        weights = np.concatenate([index['weights'], weights])
+
+    index = {'hashes': hashes, 'keep': keep, 'weights': weights}
+
+    path = os.path.join(outputdir, INDEX)
+
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **index)
+
+    os.replace(path + '.tmp', path)
+
+    counts = np.bincount(np.asarray(labels)[keep], minlength = CLASSES)
+
+    print('Indexed ' + str(len(hashes) - start) + ' images, keeping ' + str(int(keep.sum())) + ' of ' +
+          str(len(keep)) + '. Images kept of each class: ' + ', '.join(str(count) for count in counts))
+
+    return index
+
+class BalancedSampler:
+    '''Draws rows with every class equally likely, without making a rebalanced
+    copy of the dataset. The rows of each class are kept one after another in
+    a single array, so drawing a row is picking a class, then an offset into
+    that class's part of the array, whatever the size of the dataset'''
+
+    def __init__(self, labels, rows, classes = CLASSES):
+        indices = class_indices(labels, np.asarray(rows), classes)
+
+        self.rows = np.concatenate(indices)
+        self.counts = np.array([len(rows) for rows in indices])
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)[:-1]])
+        self.classes = np.flatnonzero(self.counts) # Classes with no rows are never drawn
+
+    def __len__(self):
+        return len(self.rows)
+
+    def sample(self, count, random):
+        '''Returns count rows drawn with a RandomState, each class equally likely'''
+
+        classes = self.classes[random.randint(len(self.classes), size = count)]
+        offsets = (random.rand(count) * self.counts[classes]).astype(np.int64)
+
+        return self.rows[self.offsets[classes] + offsets]
+
+def main():
+    make_index(OUTPUTDIR)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+'''Defines the on-disk format of a recording session, and the SessionWriter
+class that streams samples into it on a background thread. A session is a
+directory of numbered chunk files, each holding a uint8 image tensor, int8
+labels, and float64 capture timestamps. Once every chunk has been written,
+an empty marker file is added, so a session that is still being recorded, or
+was cut short by a crash, can be told apart from a finished one.'''
+
+import os
+import numpy as np
+
+from queue import Queue
+from threading import Thread
+
+CHUNK_SIZE = 256 # Samples held in memory before a chunk is written to disk
+COMPLETE = 'complete' # Marker file written into a session once it is closed
+
+
+class SessionWriter:
+    '''Collects samples into a preallocated chunk, and hands each full chunk to
+    a background thread that writes it to disk. At most one chunk of samples
+    is held in memory, so at most one chunk is lost if the car crashes. The
+    directory is only created when the first chunk is written, so a session
+    with no samples leaves nothing behind.'''
+
+    def __init__(self, directory, chunk_size = CHUNK_SIZE):
+        self.directory = directory
+        self.chunk_size = chunk_size
+
+        self.chunks = 0 # Number of chunks handed to the writer thread
+        self.count = 0 # Number of samples in the current chunk
+        self.images = None # Allocated once the image shape is known
+
+        if os.path.exists(directory):
+            raise FileExistsError(directory)
+
+        self.queue = Queue()
+
+        self.thread = Thread(target = self.run)
+        self.thread.daemon = True
+
+        self.thread.start()
+
+    def allocate(self, shape):
+        '''Allocates the arrays for the next chunk'''
+
+        self.images = np.empty((self.chunk_size,) + shape, dtype = np.uint8)
+        self.labels = np.empty(self.chunk_size, dtype = np.int8)
+        self.timestamps = np.empty(self.chunk_size, dtype = np.float64)
+
+    def add(self, image, label, timestamp):
+        '''Copies a sample into the current chunk, and queues the chunk
+        to be written once it is full'''
+
+        if self.images is None:
+            self.allocate(image.shape)
+
+        self.images[self.count] = image
+        self.labels[self.count] = label
+        self.timestamps[self.count] = timestamp
+
+        self.count += 1
+
+        if self.count == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        '''Queues the current chunk to be written, and starts a new one'''
+
+        if self.count == 0:
+            return
+
+        path = os.path.join(self.directory, 'chunk%05d.npz' % self.chunks)
+
+        self.queue.put((path, self.images[:self.count], self.labels[:self.count], self.timestamps[:self.count]))
+
+        self.chunks += 1
+        self.count = 0
+        self.allocate(self.images.shape[1:])
+
+    def close(self):
+        '''Queues the final partial chunk and stops the writer thread once
+        everything queued has been written and the session has been marked
+        complete. Does not wait for the writes.'''
+
+        self.flush()
+        self.queue.put(None)
+
+    def join(self):
+        '''Waits until every queued chunk has been written'''
+
+        self.thread.join()
+
+    def run(self):
+        '''The writer thread. Each chunk is written to a temporary file and
+        renamed into place, so a chunk file is either complete or absent.'''
+
+        while True:
+            item = self.queue.get()
+
+            if item is None:
+                break
+
+            path, images, labels, timestamps = item
+
+            os.makedirs(self.directory, exist_ok = True)
+
+            with open(path + '.tmp', 'wb') as f:
+                np.savez(f, images = images, labels = labels, timestamps = timestamps)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(path + '.tmp', path)
+
+        # A session without any samples has no directory to mark
+        if self.chunks > 0:
+            with open(os.path.join(self.directory, COMPLETE), 'wb') as f:
+                os.fsync(f.fileno())
+
+def is_session(path):
+    '''Returns whether a path is a chunked session directory'''
+
+    return os.path.isdir(path)
+
+def is_complete(path):
+    '''Returns whether a session has been closed, so no more chunks will be
+    added to it. Sessions in the old single file format are always complete'''
+
+    return not is_session(path) or os.path.exists(os.path.join(path, COMPLETE))
+
+def chunk_paths(directory):
+    '''Returns the paths of a session's complete chunks, in order'''
+
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith('.npz')]
+
+def iter_chunks(directory):
+    '''Yields (images, labels, timestamps) for each chunk of a session'''
+
+    for path in chunk_paths(directory):
+        with np.load(path) as chunk:
+            yield chunk['images'], chunk['labels'], chunk['timestamps']
+
+def load_session(directory):
+    '''Loads a whole session as (images, labels, timestamps) arrays'''
+
+    chunks = list(iter_chunks(directory))
+
+    if len(chunks) == 0:
+        return np.empty((0, 0, 0), dtype = np.uint8), np.empty(0, dtype = np.int8), np.empty(0)
+
+    images, labels, timestamps = zip(*chunks)
+
+    return np.concatenate(images), np.concatenate(labels), np.concatenate(timestamps)
+
+def load_legacy(path):
+    '''Loads a session saved in the old format, a single .npy object array
+    of (image, label) rows, as (images, labels, timestamps) arrays. The old
+    format did not record timestamps, so they are all zero'''
+
+    rows = np.load(path, allow_pickle = True)
+
+    images = np.array([image for image in rows[:, 0]], dtype = np.uint8)
+    labels = rows[:, 1].astype(np.int8)
+
+    return images, labels, np.zeros(len(labels))
+
+def session_length(path):
+    '''Returns the number of samples in a session of either format, reading
+    only the labels of a chunked session'''
+
+    if not is_session(path):
+        return len(np.load(path, allow_pickle = True))
+
+    length = 0
+
+    for chunk_path in chunk_paths(path):
+        with np.load(chunk_path) as chunk:
+            length += len(chunk['labels'])
+
+    return length
+
+def load(path):
+    '''Loads a session of either format as (images, labels, timestamps) arrays'''
+
+    if is_session(path):
+        return load_session(path)
+
+    return load_legacy(path)
@@ -0,0 +1,149 @@
+'''Defines the FrameRing class, a ring of camera frames in shared memory that
+one process writes and any number of processes read, and the SharedCamera
+class, which gives those readers the same interface as the Camera. Used by
+the multi-process pipeline in pipeline.py.'''
+
+import numpy as np
+import multiprocessing
+
+from time import sleep
+from multiprocessing.shared_memory import SharedMemory
+
+from camera import Camera, Frame, BUFFERS
+
+SLOTS = 8 # Frames kept in the ring, so a slow reader is never overtaken mid-copy
+BACKOFF = 0.0005 # Seconds a reader sleeps when the newest slot is being written, before trying again
+
+
+class FrameRing:
+    '''A fixed ring of frame slots in one block of shared memory. Each slot has
+    a version counter, which the writer makes odd while it is copying a frame
+    into the slot and even again once it is done, like a seqlock. A reader
+    copies the slot out and then checks the version has not changed, and
+    tries again if it has. The versions and the newest sequence number are
+    only changed and read while holding a lock, which orders them with the
+    frame copies on every CPU, but the lock is never held while a frame is
+    copied, so a reader never waits for the writer to copy a frame.'''
+
+    def __init__(self, resolution, framerate, slots = SLOTS, context = multiprocessing):
+        self.resolution = resolution
+        self.framerate = framerate
+        self.slots = slots
+
+        size = 8 + slots * 24 + slots * resolution * resolution
+
+        self.memory = SharedMemory(create = True, size = size)
+        self.lock = context.Lock() # Guards the versions and the newest sequence number
+        self.condition = context.Condition() # Wakes readers waiting for a new frame
+        self.count = 0 # Frames written, only used by the writer
+
+        buffer = self.memory.buf
+
+        self.latest = np.ndarray(1, dtype = np.int64, buffer = buffer) # Sequence number of the newest frame
+        self.versions = np.ndarray(slots, dtype = np.int64, buffer = buffer, offset = 8)
+        self.seqs = np.ndarray(slots, dtype = np.int64, buffer = buffer, offset = 8 + slots * 8)
+        self.timestamps = np.ndarray(slots, dtype = np.float64, buffer = buffer, offset = 8 + slots * 16)
+        self.frames = np.ndarray((slots, resolution, resolution), dtype = np.uint8, buffer = buffer,
+                                 offset = 8 + slots * 24)
+
+        self.latest[0] = -1
+        self.versions[:] = 0
+
+    def write(self, plane, timestamp):
+        '''Copies a frame into the next slot and publishes it. There must only
+        be one writer'''
+
+        seq = self.count
+        slot = seq % self.slots
+
+        with self.lock:
+            self.versions[slot] += 1
+
+        self.frames[slot] = plane
+        self.seqs[slot] = seq
+        self.timestamps[slot] = timestamp
+
+        with self.lock:
+            self.versions[slot] += 1
+            self.latest[0] = seq
+
+        self.count += 1
+
+        with self.condition:
+            self.condition.notify_all()
+
+    def read(self, out):
+        '''Copies the newest frame into out, and returns its sequence number and
+        timestamp, or None if nothing has been written yet'''
+
+        while True:
+            with self.lock:
+                seq = int(self.latest[0])
+
+                if seq < 0:
+                    return None
+
+                slot = seq % self.slots
+                version = int(self.versions[slot])
+
+            if version % 2:
+                sleep(BACKOFF) # The writer has lapped the ring and is copying into this slot
+                continue
+
+            out[...] = self.frames[slot]
+            seq, timestamp = int(self.seqs[slot]), float(self.timestamps[slot])
+
+            with self.lock:
+                if int(self.versions[slot]) == version:
+                    return seq, timestamp
+
+    def wait(self, seq = -1, timeout = None):
+        '''Blocks until a frame newer than seq has been written. Returns whether
+        one has, or False on timeout'''
+
+        if self.latest[0] > seq:
+            return True
+
+        with self.condition:
+            return self.condition.wait_for(lambda: self.latest[0] > seq, timeout)
+
+    def close(self, unlink = False):
+        '''Detaches from the shared memory. The process that created the ring
+        unlinks it once every process is done with it'''
+
+        self.latest = self.versions = self.seqs = self.timestamps = self.frames = None
+        self.memory.close()
+
+        if unlink:
+            self.memory.unlink()
+
+        self.memory = None
+
+class SharedCamera(Camera):
+    '''A Camera that reads the frames another process writes into a FrameRing,
+    instead of capturing them itself. Frames keep the sequence numbers and
+    capture timestamps of the capture process, so the AutoDriver's deadlines
+    and dropped frame counts still measure from the moment of capture.'''
+
+    def __init__(self, ring):
+        self.ring = ring
+
+        Camera.__init__(self, ring.resolution, ring.framerate, source = ring)
+
+    def run(self):
+        '''Copies each new frame out of the ring into the next local buffer,
+        and publishes it like the Camera's capture thread does'''
+
+        seq = -1
+        count = 0
+
+        while True:
+            if not self.ring.wait(seq, timeout = 1):
+                continue
+
+            luma = self.buffers[count % BUFFERS]
+            seq, timestamp = self.ring.read(luma)
+
+            self.publish(Frame(seq, timestamp, luma))
+
+            count += 1
@@ -0,0 +1,129 @@
+'''Defines the frame sources the Camera can capture from. The PiCamera source
+drives the real camera, and the replay source streams previously recorded
+frames so the rest of the system can run without any camera hardware.'''
+
+import os
+import numpy as np
+
+from time import sleep, time
+from PIL import Image
+
+from session import is_session, iter_chunks
+
+
+class FrameSource:
+    '''Base class for camera backends. A source is a generator factory that
+    yields square, 2D uint8 luma arrays of the requested resolution'''
+
+    def frames(self, resolution, framerate):
+        raise NotImplementedError
+
+class LumaOutput:
+    '''A file-like object that picamera writes raw YUV420 captures into. Only
+    the Y (luma) plane is kept, copied straight into a preallocated buffer, and
+    the chroma planes that follow it are discarded'''
+
+    def __init__(self, resolution):
+        # picamera pads raw captures to a width of 32 and a height of 16 pixels
+        self.width = (resolution + 31) // 32 * 32
+        self.height = (resolution + 15) // 16 * 16
+        self.size = self.width * self.height
+
+        self.buffer = np.empty(self.size, dtype = np.uint8)
+        self.offset = 0
+
+    def write(self, data):
+        '''Called by picamera with each chunk of a capture'''
+
+        count = min(len(data), self.size - self.offset)
+
+        if count > 0:
+            self.buffer[self.offset:self.offset + count] = np.frombuffer(data, dtype = np.uint8, count = count)
+
+        self.offset += len(data)
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def rewind(self):
+        '''Prepares the output for the next capture'''
+
+        self.offset = 0
+
+    def plane(self):
+        '''Returns the padded Y plane of the last capture as a 2D array'''
+
+        return self.buffer.reshape(self.height, self.width)
+
+class PiCameraSource(FrameSource):
+    '''Captures frames from the Raspberry Pi camera. picamera is only imported
+    once capturing starts, so this module can be imported anywhere'''
+
+    def frames(self, resolution, framerate):
+        '''Frames are captured from the camera in this generator. The resolution
+        and framerate are set, and the camera takes black and white images.'''
+
+        import picamera
+
+        with picamera.PiCamera() as camera:
+            camera.resolution = (resolution, resolution)
+            camera.framerate = framerate
+            camera.color_effects = (128, 128) # Makes the output black and white
+
+            sleep(1) # Camera warm-up time
+
+            output = LumaOutput(resolution)
+
+            for _ in camera.capture_continuous(output, 'yuv', use_video_port = True):
+                yield output.plane()[:resolution, :resolution]
+
+                output.rewind()
+
+class ReplaySource(FrameSource):
+    '''Streams frames from recorded sessions in a directory, or from a directory
+    of jpeg images. A speed of 1 replays at the camera framerate, larger values
+    replay faster, and a speed of None replays as fast as possible'''
+
+    def __init__(self, directory, speed = 1, loop = True):
+        self.directory = directory
+        self.speed = speed
+        self.loop = loop
+
+    def images(self):
+        '''Yields every recorded image in the directory, in filename order'''
+
+        for filename in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, filename)
+
+            if is_session(path):
+                for images, _, _ in iter_chunks(path):
+                    yield from images
+            elif filename.endswith('.npy'):
+                for image, _ in np.load(path, allow_pickle = True):
+                    yield image
+            elif filename.lower().endswith(('.jpg', '.jpeg')):
+                yield np.asarray(Image.open(path).convert('L'))
+
+    def frames(self, resolution, framerate):
+        period = None if self.speed is None else 1 / (framerate * self.speed)
+        deadline = time()
+
+        while True:
+            count = 0
+
+            for image in self.images():
+                if image.shape != (resolution, resolution):
+                    image = np.asarray(Image.fromarray(image).resize((resolution, resolution)))
+
+                if period is not None:
+                    deadline += period
+                    sleep(max(0, deadline - time()))
+
+                count += 1
+
+                yield image
+
+            if not self.loop or count == 0:
+                return
@@ -1,18 +1,42 @@
-var REFRESHRATE = 1000; // Interval between remote control's image update
-
 var recording = false; // Whether or not the car is recording
 var automatic = false; // Whether or not the car is in auto mode
 
+var client = Math.random().toString(36).slice(2); // Identifies this remote to the car
+var seq = 0; // Number of the last command sent, so the car can drop late ones
+
+/***
+ * Sends a numbered command to the car over a kept-alive connection
+ * The car ignores any command older than one of the same kind it has
+ * already applied, so steering never cancels driving or the reverse
+***/
+function sendCommand(cmd){
+    seq += 1;
+
+    fetch('/control', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({client: client, seq: seq, cmd: cmd}),
+        keepalive: true
+    });
+}
+
 /***
- * Sends simple GET requests to control various aspects of the car
+ * Listens for status updates the car pushes to the remote
+ * Buttons show the car's actual state rather than a guess
 ***/
-function sendRequest(route, callback){
-    request = new XMLHttpRequest();
+function listenStatus(){
+    var events = new EventSource('/events');
 
-    request.onload = callback;
+    events.onmessage = function(event){
+        var status = JSON.parse(event.data);
 
-    request.open('GET', route, true);
-    request.send();
+        recording = status.recording;
+        automatic = status.auto;
+
+        recordButton.innerText = recording?'Stop Recording':'Start Recording';
+        autoButton.innerText = automatic?'Auto Off':'Auto On';
+        autoButton.disabled = !status.ready; // Auto mode is available once the model has loaded
+    };
 }
 
 /***
@@ -27,41 +51,35 @@ function addEventListeners(object, events, callback){
 }
 
 /***
- * Updates the image on the remote control
- * Adds the date to change the link, and "bust" the cache
+ * Starts the live video on the remote control
+ * The server keeps pushing new frames over this one connection
 ***/
-function updateImage() {
-    document.getElementById("image").src = "/image?" + Date.now()
+function startStream() {
+    document.getElementById("image").src = "/stream"
 }
 
 /***
  * Toggles the automatic mode for the car
- * Updates the button's text accordingly
+ * The button's text is updated by the next status update
 ***/
 
 function toggleAuto() {
-    sendRequest('auto')
-
-    automatic = !automatic
-
-    autoButton.innerText = automatic?'Auto Off':'Auto On';
+    sendCommand('auto')
 }
 
 
 /***
  * Toggles the recording mode for the car
- * Updates the button's text accordingly
+ * The button's text is updated by the next status update
 ***/
 function toggleRecord() {
-    sendRequest('record')
-
-    recording = !recording
-
-    recordButton.innerText = recording?'Stop Recording':'Start Recording'
+    sendCommand('record')
 }
 
 window.onload = function(){
-    sendRequest('/drive/stop'); // Stop the car if it is moving ASAP
+    sendCommand('stop'); // Stop the car if it is moving ASAP
+    startStream();
+    listenStatus();
 };
 
 // Store buttons in variables to clean up code
@@ -74,20 +92,18 @@ recordButton = document.getElementById('record');
 autoButton = document.getElementById('auto');
 
 // Events listeners for driving when buttons are pressed
-addEventListeners(forwardButton, 'touchstart', function(){sendRequest('drive/forward')});
-addEventListeners(backwardButton, 'touchstart', function(){sendRequest('drive/backward')});
-addEventListeners(leftButton, 'touchstart', function(){sendRequest('drive/left')});
-addEventListeners(rightButton, 'touchstart', function(){sendRequest('drive/right')});
-addEventListeners(stopButton, 'touchstart', function(){sendRequest('drive/stop')});
+addEventListeners(forwardButton, 'touchstart', function(){sendCommand('forward')});
+addEventListeners(backwardButton, 'touchstart', function(){sendCommand('backward')});
+addEventListeners(leftButton, 'touchstart', function(){sendCommand('left')});
+addEventListeners(rightButton, 'touchstart', function(){sendCommand('right')});
+addEventListeners(stopButton, 'touchstart', function(){sendCommand('stop')});
 
 // Event listeners for driving when buttons are released
-addEventListeners(forwardButton, 'touchend touchcancel', function(){sendRequest('drive/stop')});
-addEventListeners(backwardButton, 'touchend touchcancel', function(){sendRequest('drive/stop')});
-addEventListeners(leftButton, 'touchend touchcancel', function(){sendRequest('drive/straight')});
-addEventListeners(rightButton, 'touchend touchcancel', function(){sendRequest('drive/straight')});
+addEventListeners(forwardButton, 'touchend touchcancel', function(){sendCommand('stop')});
+addEventListeners(backwardButton, 'touchend touchcancel', function(){sendCommand('stop')});
+addEventListeners(leftButton, 'touchend touchcancel', function(){sendCommand('straight')});
+addEventListeners(rightButton, 'touchend touchcancel', function(){sendCommand('straight')});
 
 // Event listeners for controlling car modes
 addEventListeners(recordButton, 'touchstart', toggleRecord);
 addEventListeners(autoButton, 'touchstart', toggleAuto)
-
-setInterval(updateImage, REFRESHRATE); // Set update interval
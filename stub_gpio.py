@@ -0,0 +1,58 @@
+'''Defines StubGPIO, a stand-in for the RPi.GPIO module that drives no
+hardware and instead records every command it receives. Lets the car be
+constructed and driven on machines that are not a Raspberry Pi.'''
+
+from time import time
+
+
+class StubPWM:
+    '''Mirrors the RPi.GPIO PWM class, logging duty cycle changes'''
+
+    def __init__(self, gpio, pin, frequency):
+        self.gpio = gpio
+        self.pin = pin
+        self.frequency = frequency
+
+    def start(self, duty):
+        self.gpio.record(self.pin, 'pwm', duty)
+
+    def ChangeDutyCycle(self, duty):
+        self.gpio.record(self.pin, 'pwm', duty)
+
+    def stop(self):
+        self.gpio.record(self.pin, 'pwm', 0)
+
+class StubGPIO:
+    '''Mirrors the parts of the RPi.GPIO module that the car uses. Each
+    command is appended to the log as a (time, pin, kind, value) tuple'''
+
+    BCM = 'BCM'
+    OUT = 'OUT'
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self):
+        self.log = []
+        self.pins = {} # Latest value written to each pin
+
+    def record(self, pin, kind, value):
+        self.log.append((time(), pin, kind, value))
+        self.pins[pin] = value
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, mode):
+        self.record(pin, 'setup', mode)
+
+    def output(self, pin, value):
+        self.record(pin, 'output', value)
+
+    def PWM(self, pin, frequency):
+        return StubPWM(self, pin, frequency)
+
+    def cleanup(self):
+        self.pins = {}
@@ -0,0 +1,176 @@
+'''Trains every combination of a grid of candidate models, input scales,
+batch sizes and epochs, in parallel, and records how each one did. This
+file is run to compare the models in models.py. Every result is appended
+to the results file as soon as it finishes, so an interrupted sweep picks
+up where it left off when it is run again.'''
+
+import os
+import csv
+import json
+import itertools
+import multiprocessing
+
+from process import SCALES, RESOLUTION
+
+DATASET = 'datasets'
+OUTPUTDIR = 'sweeps'
+RESULTS = 'results.jsonl' # One JSON result per line, appended as configs finish
+TABLE = 'results.csv' # The finished results, sorted by validation accuracy
+
+GRID = {'model': ['modelA', 'modelB', 'modelC', 'modelD', 'modelE'],
+        'scale': SCALES,
+        'batch_size': [32, 64],
+        'epochs': [20],
+        'augment': [False, True],
+        'frames': [1]} # Add 4 to compare stacks of frames, once process.py has made them
+
+SEED = 0 # Seed of the shuffling and augmentation, so sweeps are reproducible
+WORKERS = os.cpu_count() or 1 # Configs trained at once
+THREADS = 1 # Threads each worker's tensorflow session may use
+LATENCY_SAMPLES = 200 # Images used to time single-image inference
+
+TARGET_NAMES = ['Left', 'Right', 'Straight']
+
+
+def configs(grid):
+    '''Returns every combination of the grid's values as a list of dicts'''
+
+    names = sorted(grid)
+
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+def key(config):
+    '''Returns a short name that identifies a config, like modelA-s4-b64-e20-f4-aug'''
+
+    name = '{model}-s{scale}-b{batch_size}-e{epochs}'.format(**config)
+
+    if config.get('frames', 1) > 1:
+        name += '-f' + str(config['frames'])
+
+    return name + '-aug' if config.get('augment') else name
+
+def completed(path):
+    '''Returns the results that were already recorded, by config key'''
+
+    results = {}
+
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    results[result['key']] = result
+
+    return results
+
+def limit_threads():
+    '''Runs in each worker process before any config. Keeps each worker's
+    tensorflow to a few threads so the workers do not fight over the cores'''
+
+    import tensorflow as tf
+
+    if hasattr(tf, 'ConfigProto'):
+        from keras import backend
+
+        config = tf.ConfigProto(intra_op_parallelism_threads = THREADS, inter_op_parallelism_threads = 1)
+        backend.set_session(tf.Session(config = config))
+
+def run(config):
+    '''Trains one config in a worker process, and returns its result. Every
+    worker memory-maps the same dataset files, so the operating system shares
+    their pages between workers instead of each worker loading its own copy'''
+
+    import numpy as np
+    import models
+
+    from sklearn.metrics import precision_recall_fscore_support
+
+    from process import load_dataset, prep_images
+    from batches import BatchSequence, split
+    from runners import latency
+    from train import train
+    from augment import Augmenter
+
+    size = int(RESOLUTION / config['scale'])
+    output = os.path.join(OUTPUTDIR, key(config))
+
+    frames = config.get('frames', 1)
+
+    images, labels, _ = load_dataset(DATASET, config['scale'], frames)
+
+    model = getattr(models, config['model'])(input_shape = (size, size, frames))
+    augment = Augmenter(seed = SEED) if config.get('augment') else None
+    history = train(model, images, labels, output, batch_size = config['batch_size'], epochs = config['epochs'],
+                    verbose = 0, augment = augment, seed = SEED)
+
+    model.load_weights(output) # The best checkpoint, rather than the last epoch
+
+    _, val_indices = split(len(labels), 0.1)
+    batches = BatchSequence(images, labels, val_indices, config['batch_size'], shuffle = False)
+
+    predicted = np.argmax(model.predict_generator(batches), axis = 1)
+    precision, recall, f1, support = precision_recall_fscore_support(labels[val_indices], predicted, labels = [0, 1, 2])
+
+    accuracy = history.history.get('val_acc', history.history.get('val_accuracy'))
+
+    result = dict(config)
+    result.update({'key': key(config),
+                   'val_acc': float(max(accuracy)),
+                   'params': int(model.count_params()),
+                   'latency': latency(model, prep_images(images[val_indices[:LATENCY_SAMPLES]]))})
+
+    for i, name in enumerate(TARGET_NAMES):
+        result[name + '_precision'] = float(precision[i])
+        result[name + '_recall'] = float(recall[i])
+        result[name + '_f1'] = float(f1[i])
+        result[name + '_support'] = int(support[i])
+
+    return result
+
+def write_table(results, path):
+    '''Writes the results as a CSV table, best validation accuracy first'''
+
+    rows = sorted(results.values(), key = lambda result: result['val_acc'], reverse = True)
+
+    if not rows:
+        return
+
+    columns = list(rows[0])
+
+    with open(path, 'w', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def sweep(grid, workers = WORKERS):
+    '''Trains every config of the grid that does not have a result yet'''
+
+    os.makedirs(OUTPUTDIR, exist_ok = True)
+
+    path = os.path.join(OUTPUTDIR, RESULTS)
+    results = completed(path)
+    pending = [config for config in configs(grid) if key(config) not in results]
+
+    print(str(len(results)) + ' configs already done, ' + str(len(pending)) + ' to train')
+
+    # Spawned workers import tensorflow fresh, and are replaced after every
+    # config so each model's memory is given back
+    context = multiprocessing.get_context('spawn')
+
+    with context.Pool(workers, initializer = limit_threads, maxtasksperchild = 1) as pool:
+        for result in pool.imap_unordered(run, pending):
+            with open(path, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+
+            results[result['key']] = result
+            print('{key}: val acc {val_acc:.4f}, {params} params, {latency_ms:.3f} ms'.format(latency_ms = result['latency'] * 1000, **result))
+
+    write_table(results, os.path.join(OUTPUTDIR, TABLE))
+
+    return results
+
+def main():
+    sweep(GRID)
+
+if __name__ == '__main__':
+    main()
@@ -13,30 +13,65 @@ from keras.callbacks import ModelCheckpoint
 
 from sklearn.metrics import classification_report
 
-from models import modelA, modelB, modelC, modelD, modelE
-from process import prep_images, prep_labels
+from models import modelA, modelB, modelC, modelD, modelE, modelF
+from process import load_dataset, read_manifest, prep_labels, RESOLUTION
+from batches import BatchSequence, BalancedSequence, split
+from augment import Augmenter
+from registry import write_metadata
+from sampling import BalancedSampler, read_index
 
 BATCH_SIZE = 64
 EPOCHS = 20
 VAL_SPLIT = 0.1
+WORKERS = 4 # Threads that prepare batches in the background while the model trains
+QUEUE_SIZE = 10 # Batches prepared ahead of the model
 
-IMAGEPATH = 'datasets/image16.npy'
-LABELPATH = 'datasets/labels.npy'
+DATASET = 'datasets'
+SCALE = 4 # Trains on the 16x16 images
+FRAMES = 1 # Frames stacked into each input. Above 1, the stacks are made by process.py
 
-MODEL = modelA()
+MODEL = modelA
 OUTPUT = 'models/modelA7'
 
-IMAGES = prep_images(np.load(IMAGEPATH))
-LABELS = prep_labels(np.load(LABELPATH))
+AUGMENT = Augmenter(seed = 0) # Set to None to train on the recorded images only
+DEDUPE = None # 'drop' leaves out near-duplicate images, 'weight' shares their weight, None uses them all. Run sampling.py first
+BALANCE = False # Draws every class equally often in training batches
 
-def train(model, images, labels, output):
-    callback = ModelCheckpoint(filepath = output, monitor = 'val_acc', verbose = 1, save_best_only = True)
+def train(model, images, labels, output, batch_size = BATCH_SIZE, epochs = EPOCHS, verbose = 1, augment = None, seed = None,
+          keep = None, weights = None, balance = False, indices = None, optimizer = None):
+    '''Trains a model on memory-mapped images and labels, streaming them in
+    batches instead of loading the whole dataset into memory. Only the
+    training batches are augmented, never the validation batches. Giving a
+    seed makes the order the rows are shuffled in reproducible. Training rows
+    can be left out with a keep mask, weighted, or drawn so every class is
+    equally likely, but not both weighted and balanced. A pair of
+    (training, validation) row arrays can be given instead of splitting
+    the rows by VAL_SPLIT, and an optimizer instead of the default Adam'''
 
-    model.compile(loss=keras.losses.categorical_crossentropy, optimizer=keras.optimizers.Adam(), metrics=['accuracy'])
+    if balance and weights is not None:
+        raise ValueError('Training batches cannot be both balanced and weighted')
 
-    return model.fit(images, labels, batch_size = BATCH_SIZE, epochs = EPOCHS, validation_split = VAL_SPLIT, callbacks = [callback])
+    callback = ModelCheckpoint(filepath = output, monitor = 'val_acc', verbose = verbose, save_best_only = True)
 
-def report(history, model):
+    model.compile(loss=keras.losses.categorical_crossentropy, optimizer=optimizer or keras.optimizers.Adam(), metrics=['accuracy'])
+
+    train_indices, val_indices = indices if indices is not None else split(len(labels), VAL_SPLIT)
+
+    if keep is not None:
+        train_indices = train_indices[keep[train_indices]]
+
+    if balance:
+        sampler = BalancedSampler(labels, train_indices)
+        train_batches = BalancedSequence(images, labels, sampler, batch_size, seed = seed or 0, augment = augment)
+    else:
+        train_batches = BatchSequence(images, labels, train_indices, batch_size, seed = seed, augment = augment,
+                                      weights = weights)
+    val_batches = BatchSequence(images, labels, val_indices, batch_size, shuffle = False)
+
+    return model.fit_generator(train_batches, epochs = epochs, validation_data = val_batches, callbacks = [callback],
+                               workers = WORKERS, use_multiprocessing = False, max_queue_size = QUEUE_SIZE, verbose = verbose)
+
+def report(history, model, images, labels):
     '''Gives a variety of information about the model\'s training. Adapted from Aditya Sharma:
     https://www.datacamp.com/community/tutorials/convolutional-neural-networks-python'''
 
@@ -49,10 +84,13 @@ def report(history, model):
     plt.legend()
     plt.show()
 
-    predicted_classes = model.predict(IMAGES)
+    batches = BatchSequence(images, labels, np.arange(len(labels)), BATCH_SIZE, shuffle = False)
+
+    predicted_classes = model.predict_generator(batches, workers = WORKERS)
     predicted_classes = np.argmax(np.round(predicted_classes),axis=1)
 
-    raw_labels = np.load(LABELPATH)
+    raw_labels = np.asarray(labels)
+    dim = images.shape[1]
 
     target_names = ['Left', 'Right', 'Straight']
 
@@ -60,7 +98,7 @@ def report(history, model):
     correct = np.where(predicted_classes == raw_labels)[0]
     for i, correct in enumerate(np.random.choice(correct, 9)):
         plt.subplot(3, 3, i + 1)
-        plt.imshow(IMAGES[correct].reshape(16, 16), cmap = 'gray', interpolation = 'none')
+        plt.imshow(images[correct].reshape(dim, dim, -1)[..., -1], cmap = 'gray', interpolation = 'none')
         plt.title("P: {}, L: {}".format(target_names[predicted_classes[correct]], target_names[raw_labels[correct]]))
         plt.tight_layout()
 
@@ -70,17 +108,43 @@ def report(history, model):
     incorrect = np.where(predicted_classes != raw_labels)[0]
     for i, incorrect in enumerate(np.random.choice(incorrect, 9)):
         plt.subplot(3, 3, i + 1)
-        plt.imshow(IMAGES[incorrect].reshape(16, 16), cmap = 'gray', interpolation = 'none')
+        plt.imshow(images[incorrect].reshape(dim, dim, -1)[..., -1], cmap = 'gray', interpolation = 'none')
         plt.title("P: {}, L: {}".format(target_names[predicted_classes[incorrect]], target_names[raw_labels[incorrect]]))
         plt.tight_layout()
 
     plt.show()
 
-    print(classification_report(LABELS, prep_labels(predicted_classes), target_names = target_names))
+    print(classification_report(prep_labels(raw_labels), prep_labels(predicted_classes), target_names = target_names))
 
 def main():
-    history = train(MODEL, IMAGES, LABELS, OUTPUT)
-    report(history, MODEL)
+    images, labels, _ = load_dataset(DATASET, SCALE, FRAMES)
+
+    size = int(RESOLUTION / SCALE)
+    model = MODEL(input_shape = (size, size, FRAMES))
+
+    index = read_index(DATASET) if DEDUPE else None
+
+    if DEDUPE and (index is None or len(index['keep']) != len(labels)):
+        raise ValueError('The index of ' + DATASET + ' is out of date. Run sampling.py to update it')
+
+    history = train(model, images, labels, OUTPUT, augment = AUGMENT,
+                    keep = index['keep'] if DEDUPE == 'drop' else None,
+                    weights = index['weights'] if DEDUPE == 'weight' else None,
+                    balance = BALANCE)
+
+    accuracy = history.history.get('val_acc', history.history.get('val_accuracy'))
+    manifest = read_manifest(DATASET)
+
+    write_metadata(OUTPUT, {'model': MODEL.__name__,
+                            'input_shape': [size, size, FRAMES],
+                            'scale': SCALE,
+                            'frames': FRAMES,
+                            'resample': manifest.get('resample', 'slice'),
+                            'samples': manifest['count'],
+                            'sessions': [entry['name'] for entry in manifest['sessions']],
+                            'val_acc': float(max(accuracy))})
+
+    report(history, model, images, labels)
 
 if __name__ == '__main__':
     main()